@@ -0,0 +1,2 @@
+# Offline benchmark for the load -> clean -> dbt transform -> analysis pipeline
+# generate.py writes synthetic monthly trip files, run.py runs every stage against them and records metrics
@@ -0,0 +1,104 @@
+import argparse
+import logging
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Deterministic generator for synthetic yellow/green monthly trip files
+# Files follow the TLC names and schema (yellow_tripdata_YYYY-MM.parquet, tpep_/lpep_ timestamps, extra columns
+# load.py has to project away) so load.py can read them with --base-url file://<dir>
+# The same seed and config always produce byte-identical files
+
+logger = logging.getLogger(__name__)
+
+# Rates of the rows clean.py is expected to drop, as fractions of each file
+default_rates = {
+    "duplicate_rate": 0.01,
+    "zero_passenger_rate": 0.02,
+    "zero_distance_rate": 0.015,
+    "long_distance_rate": 0.001,
+    "long_duration_rate": 0.001,
+}
+
+prefixes = {"yellow": "tpep", "green": "lpep"}
+
+
+# One month of trips for one cab type as an Arrow table
+def generate_month(cab_type, year, month, rows, rng, rates=default_rates):
+    prefix = prefixes[cab_type]
+    start = np.datetime64(f"{year}-{month:02d}-01T00:00:00", "us")
+    end = np.datetime64(f"{year + month // 12}-{month % 12 + 1:02d}-01T00:00:00", "us")
+    span = int((end - start) / np.timedelta64(1, "us"))
+
+    pickup = start + np.sort(rng.integers(0, span, rows)).astype("timedelta64[us]")
+    distance = np.round(rng.gamma(2.0, 1.6, rows), 2)
+    # roughly 12 mph plus noise, in seconds
+    duration = np.maximum(60, distance / 12 * 3600 + rng.normal(0, 240, rows)).astype(np.int64)
+    passengers = rng.choice([1, 1, 1, 1, 2, 2, 3, 4, 5, 6], rows)
+
+    # invalid rows at the configured rates
+    passengers[rng.random(rows) < rates["zero_passenger_rate"]] = 0
+    distance[rng.random(rows) < rates["zero_distance_rate"]] = 0.0
+    far = rng.random(rows) < rates["long_distance_rate"]
+    distance[far] = np.round(rng.uniform(100.5, 500, far.sum()), 2)
+    long = rng.random(rows) < rates["long_duration_rate"]
+    duration[long] = rng.integers(86401, 3 * 86400, long.sum())
+
+    dropoff = pickup + (duration * 1_000_000).astype("timedelta64[us]")
+    columns = {
+        "VendorID": rng.integers(1, 3, rows).astype(np.int32),
+        f"{prefix}_pickup_datetime": pickup,
+        f"{prefix}_dropoff_datetime": dropoff,
+        "passenger_count": passengers.astype(np.int64),
+        "trip_distance": distance,
+        "RatecodeID": np.ones(rows, dtype=np.int64),
+        "store_and_fwd_flag": np.where(rng.random(rows) < 0.01, "Y", "N"),
+        "PULocationID": rng.integers(1, 266, rows).astype(np.int32),
+        "DOLocationID": rng.integers(1, 266, rows).astype(np.int32),
+        "payment_type": rng.integers(1, 5, rows).astype(np.int64),
+        "fare_amount": np.round(3 + distance * 2.5, 2),
+        "total_amount": np.round(5 + distance * 3.1, 2),
+    }
+    if cab_type == "green":
+        columns["trip_type"] = np.ones(rows, dtype=np.int64)
+    table = pa.table(columns)
+
+    # exact duplicates of random earlier rows
+    duplicates = int(rows * rates["duplicate_rate"])
+    if duplicates:
+        table = pa.concat_tables([table, table.take(rng.integers(0, rows, duplicates))])
+    return table
+
+
+# Writes every month for both cab types, returns the total number of rows written
+def generate(out_dir, years=(2024,), rows_per_file=100_000, seed=42, rates=default_rates):
+    os.makedirs(out_dir, exist_ok=True)
+    total = 0
+    for cab_type in prefixes:
+        for year in years:
+            for month in range(1, 13):
+                # one seed per file so any single month can be regenerated identically
+                rng = np.random.default_rng([seed, year, month, list(prefixes).index(cab_type)])
+                table = generate_month(cab_type, year, month, rows_per_file, rng, rates)
+                path = os.path.join(out_dir, f"{cab_type}_tripdata_{year}-{month:02d}.parquet")
+                pq.write_table(table, path)
+                total += table.num_rows
+                logger.info(f"Wrote {table.num_rows} rows to {path}")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic yellow/green trip files")
+    parser.add_argument("out_dir")
+    parser.add_argument("--start-year", type=int, default=2024)
+    parser.add_argument("--end-year", type=int, default=2024)
+    parser.add_argument("--rows", type=int, default=100_000, help="rows per monthly file (before duplicates)")
+    parser.add_argument("--seed", type=int, default=42)
+    for name, rate in default_rates.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=float, default=rate)
+    args = parser.parse_args()
+
+    rates = {name: getattr(args, name) for name in default_rates}
+    total = generate(args.out_dir, range(args.start_year, args.end_year + 1), args.rows, args.seed, rates)
+    print(f"Wrote {total} rows to {args.out_dir}")
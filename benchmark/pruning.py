@@ -0,0 +1,93 @@
+import argparse
+import datetime
+import duckdb
+import json
+import logging
+
+# Zone-map benchmark: how much of a transformed table a single-month analysis query reads
+# Runs the heavy/light hours question (Q2) for one pickup month on each transformed table with DuckDB's profiler on
+# and compares rows scanned with the table size. The dbt models store trips in pickup order, so only the row groups
+# of that month are read; the same query on a shuffled copy shows the full scan it would be without the ordering
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+    filename="benchmark.log"
+)
+logger = logging.getLogger(__name__)
+
+pickup_cols = {"transformed_yellow": "tpep_pickup_datetime", "transformed_green": "lpep_pickup_datetime"}
+
+
+# Q2 for one pickup month of table, read from source (the table itself by default)
+def month_query(table, month, source=None):
+    next_month = (month + datetime.timedelta(days=31)).replace(day=1)
+    return f"""
+        SELECT hour_of_day, AVG(trip_co2_kgs) AS avg_co2
+        FROM {source or table}
+        WHERE {pickup_cols[table]} >= TIMESTAMP '{month}' AND {pickup_cols[table]} < TIMESTAMP '{next_month}'
+        GROUP BY hour_of_day
+    """
+
+
+# Rows scanned and DuckDB's own latency for one query, from the JSON profile
+def profile_query(con, query):
+    con.execute(query).fetchall()
+    profile = json.loads(con.get_profiling_information(format="json"))
+    return profile["cumulative_rows_scanned"], profile["latency"]
+
+
+# Measures every transformed table; month defaults to the middle pickup month of each table
+# shuffled also runs the query on an unordered copy (a full extra copy of the table, so skip it on big databases)
+def measure_pruning(database="emissions.duckdb", month=None, shuffled=True):
+    con = duckdb.connect(database, read_only=True)
+    results = {}
+    try:
+        for table, pickup_col in pickup_cols.items():
+            rows, first, last = con.execute(f"SELECT COUNT(*), MIN({pickup_col}), MAX({pickup_col}) FROM {table}").fetchone()
+            if not rows:
+                continue
+            table_month = month or (first + (last - first) / 2).date().replace(day=1)
+            con.execute("PRAGMA enable_profiling = 'no_output'")
+            scanned, latency = profile_query(con, month_query(table, table_month))
+            stats = {
+                "month": table_month.strftime("%Y-%m"),
+                "rows": rows,
+                "rows_scanned": scanned,
+                "fraction_scanned": round(scanned / rows, 4),
+                "query_s": round(latency, 4),
+            }
+            if shuffled:
+                con.execute("PRAGMA disable_profiling")
+                con.execute(f"CREATE OR REPLACE TEMP TABLE shuffled AS SELECT * FROM {table} ORDER BY random()")
+                con.execute("PRAGMA enable_profiling = 'no_output'")
+                scanned, latency = profile_query(con, month_query(table, table_month, "temp.shuffled"))
+                stats["shuffled_rows_scanned"] = scanned
+                stats["shuffled_fraction_scanned"] = round(scanned / rows, 4)
+                stats["shuffled_query_s"] = round(latency, 4)
+                con.execute("DROP TABLE temp.shuffled")
+            results[table] = stats
+            logger.info(f"Pruning {table}: {stats}")
+    finally:
+        con.close()
+    return results
+
+
+def print_pruning(results):
+    for table, stats in results.items():
+        line = (f"{table:<20} {stats['month']}: {stats['rows_scanned']} of {stats['rows']} rows scanned "
+                f"({stats['fraction_scanned']:.1%}, {stats['query_s'] * 1000:.1f} ms)")
+        if "shuffled_rows_scanned" in stats:
+            line += (f", unordered copy {stats['shuffled_fraction_scanned']:.1%} "
+                     f"({stats['shuffled_query_s'] * 1000:.1f} ms)")
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show how much of each transformed table a single-month query reads")
+    parser.add_argument("--database", default="emissions.duckdb")
+    parser.add_argument("--month", type=lambda value: datetime.date.fromisoformat(f"{value}-01"),
+                        help="pickup month queried, YYYY-MM (default: the middle month of each table)")
+    parser.add_argument("--no-shuffled", action="store_true", help="skip the comparison with an unordered copy")
+    args = parser.parse_args()
+
+    print_pruning(measure_pruning(args.database, args.month, shuffled=not args.no_shuffled))
@@ -0,0 +1,163 @@
+import argparse
+import duckdb
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from benchmark.generate import default_rates, generate
+from benchmark.pruning import measure_pruning, print_pruning
+
+# End-to-end benchmark: generates synthetic trip files, then runs load -> clean -> dbt transform -> analysis
+# on them in a scratch directory, one subprocess per stage
+# Records wall time, rows/sec and peak RSS per stage to JSON and flags regressions against a stored baseline
+# After the transform it also records how much of each transformed table a single-month query reads (pruning.py)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+    filename="benchmark.log"
+)
+logger = logging.getLogger(__name__)
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+scripts_dir = os.path.join(repo_root, "scripts")
+dbt_dir = os.path.join(repo_root, "dbt")
+default_baseline = os.path.join(repo_root, "benchmark", "baseline.json")
+
+
+# Tables whose row count is the input size of each stage (rows/sec is measured against these)
+stage_inputs = {
+    "load": None,  # rows generated
+    "clean": ["yellow", "green"],
+    "transform": ["yellow_clean", "green_clean"],
+    "analysis": ["transformed_yellow", "transformed_green"],
+}
+
+
+def stage_commands(work_dir, data_dir, years):
+    python = sys.executable
+    return {
+        "load": [python, os.path.join(scripts_dir, "load.py"), "--base-url", f"file://{data_dir}",
+                 "--start-year", str(years[0]), "--end-year", str(years[-1]), "--rate", "0", "--full-refresh"],
+        "clean": [python, os.path.join(scripts_dir, "clean.py"), "--full"],
+        "transform": ["dbt", "run", "--project-dir", dbt_dir, "--profiles-dir", dbt_dir, "--full-refresh",
+                      "--target-path", os.path.join(work_dir, "target"), "--log-path", os.path.join(work_dir, "logs")],
+        "analysis": [python, os.path.join(scripts_dir, "analysis.py")],
+    }
+
+
+# Runs one stage as a child process; wait4 gives that child's own peak RSS
+def run_stage(command, work_dir):
+    start = time.perf_counter()
+    with open(os.path.join(work_dir, "stage_output.txt"), "a") as output:
+        process = subprocess.Popen(command, cwd=work_dir, stdout=output, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    exit_code = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss / 1024, exit_code
+
+
+def count_rows(work_dir, tables):
+    con = duckdb.connect(os.path.join(work_dir, "emissions.duckdb"), read_only=True)
+    try:
+        return sum(con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables)
+    finally:
+        con.close()
+
+
+# Runs the whole pipeline and returns the metrics for every stage
+def run_benchmark(work_dir, years=(2024,), rows_per_file=100_000, seed=42, rates=default_rates):
+    data_dir = os.path.join(work_dir, "source")
+    generated = generate(data_dir, years, rows_per_file, seed, rates)
+    shutil.copytree(os.path.join(repo_root, "data"), os.path.join(work_dir, "data"), dirs_exist_ok=True)
+    logger.info(f"Generated {generated} rows in {data_dir}")
+
+    results = {
+        "config": {"years": list(years), "rows_per_file": rows_per_file, "seed": seed, "rates": rates},
+        "stages": {},
+    }
+    for stage, command in stage_commands(work_dir, data_dir, list(years)).items():
+        if shutil.which(command[0]) is None and not os.path.exists(command[0]):
+            logger.warning(f"Skipping {stage}: {command[0]} not found")
+            print(f"{stage:<10} skipped ({command[0]} not found)")
+            continue
+
+        rows = generated if stage_inputs[stage] is None else count_rows(work_dir, stage_inputs[stage])
+        elapsed, peak_rss_mb, exit_code = run_stage(command, work_dir)
+        results["stages"][stage] = {
+            "wall_s": round(elapsed, 3),
+            "rows": rows,
+            "rows_per_s": round(rows / elapsed, 1) if elapsed else None,
+            "peak_rss_mb": round(peak_rss_mb, 1),
+            "exit_code": exit_code,
+        }
+        print(f"{stage:<10} {elapsed:8.2f}s {rows:>12} rows {rows / elapsed:>12.0f} rows/s {peak_rss_mb:8.1f} MB")
+        logger.info(f"{stage}: {results['stages'][stage]}")
+        if exit_code != 0:
+            logger.error(f"{stage} exited with {exit_code}, see {work_dir}/stage_output.txt")
+            print(f"{stage} failed (exit code {exit_code}), stopping")
+            break
+
+    if results["stages"].get("transform", {}).get("exit_code") == 0:
+        results["pruning"] = measure_pruning(os.path.join(work_dir, "emissions.duckdb"))
+        print_pruning(results["pruning"])
+    return results
+
+
+# A stage regresses when it is slower or uses more memory than the baseline by more than `tolerance`
+def find_regressions(results, baseline, tolerance=0.2):
+    regressions = []
+    if baseline.get("config") != results["config"]:
+        print("Baseline was recorded with a different config, comparison may not be meaningful")
+    for stage, stats in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous:
+            continue
+        for metric in ("wall_s", "peak_rss_mb"):
+            if previous[metric] and stats[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{stage} {metric}: {stats[metric]} vs baseline {previous[metric]}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic trip data")
+    parser.add_argument("--start-year", type=int, default=2024)
+    parser.add_argument("--end-year", type=int, default=2024)
+    parser.add_argument("--rows", type=int, default=100_000, help="rows per monthly file (before duplicates)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--work-dir", help="scratch directory (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a stage is flagged")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="taxi-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = run_benchmark(work_dir, tuple(range(args.start_year, args.end_year + 1)), args.rows, args.seed)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+            logger.warning(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline")
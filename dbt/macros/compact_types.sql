@@ -0,0 +1,20 @@
+-- schema-optimization mode: dbt run --vars '{compact: true}' (needs --full-refresh when switching)
+-- narrows the derived columns and drops columns the analysis never reads
+
+-- cast only in compact mode
+{% macro compact_cast(expression, data_type) %}
+    {%- if var('compact', false) -%}
+        cast({{ expression }} as {{ data_type }})
+    {%- else -%}
+        {{ expression }}
+    {%- endif -%}
+{% endmacro %}
+
+-- columns kept from the cleaned table: everything but the fingerprint, and in compact mode also the dropoff time
+{% macro clean_columns(alias, dropoff_col) %}
+    {%- if var('compact', false) -%}
+        {{ alias }}.* exclude (row_hash, {{ dropoff_col }})
+    {%- else -%}
+        {{ alias }}.* exclude (row_hash)
+    {%- endif -%}
+{% endmacro %}
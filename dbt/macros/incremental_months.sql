@@ -0,0 +1,49 @@
+-- helpers for the incremental transformed_* models
+-- transform_watermarks remembers, per model, how far clean_partitions had been processed and which co2 factor was used
+
+{% macro create_transform_watermarks() %}
+    create table if not exists transform_watermarks (
+        model_name varchar primary key,
+        cleaned_through timestamp,
+        co2_grams_per_mile double,
+        transformed_at timestamp
+    )
+{% endmacro %}
+
+-- pickup months cleaned since the last run, or every month if the emissions factor for this vehicle type changed
+-- trips without a pickup month have no clean_partitions row, so they are redone on every run
+-- watermark defaults to the model name; models covering both cab types pass one per cab type
+{% macro changed_months(cab_type, vehicle_type, watermark=this.name) %}
+    pickup_month is null
+    or pickup_month in (
+        select pickup_month
+        from clean_partitions
+        where cab_type = '{{ cab_type }}'
+          and cleaned_at > coalesce(
+              (select cleaned_through from transform_watermarks where model_name = '{{ watermark }}'),
+              timestamp '1900-01-01'
+          )
+    )
+    or (select co2_grams_per_mile from emissions where vehicle_type = '{{ vehicle_type }}')
+        is distinct from (select co2_grams_per_mile from transform_watermarks where model_name = '{{ watermark }}')
+{% endmacro %}
+
+-- pre_hook of the incremental models: drops every changed month from the existing table before the insert
+-- delete+insert alone only replaces months that still have rows, so a month clean.py rebuilt to zero rows
+-- (its trips moved to another month by a reload) would keep its old rows
+-- cab_column limits the delete to the cab type's rows in models covering both cab types
+{% macro delete_changed_months(cab_type, vehicle_type, watermark=this.name, cab_column=none) %}
+    {% if is_incremental() %}
+    delete from {{ this }}
+    where {% if cab_column %}{{ cab_column }} = '{{ cab_type }}' and {% endif %}({{ changed_months(cab_type, vehicle_type, watermark) }})
+    {% endif %}
+{% endmacro %}
+
+{% macro record_watermark(cab_type, vehicle_type, watermark=this.name) %}
+    insert or replace into transform_watermarks
+    select
+        '{{ watermark }}',
+        (select max(cleaned_at) from clean_partitions where cab_type = '{{ cab_type }}'),
+        (select co2_grams_per_mile from emissions where vehicle_type = '{{ vehicle_type }}'),
+        current_localtimestamp()
+{% endmacro %}
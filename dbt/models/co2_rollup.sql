@@ -0,0 +1,46 @@
+-- pre-aggregated co2 cube that analysis.py reads instead of the trip tables
+-- one row per cab type / pickup month / week / day of week / hour, with sums and counts so averages can be rebuilt as sum / count
+-- incremental like the transformed models: only pickup months rebuilt since the last run are re-aggregated
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key=['cab_type', 'pickup_month'],
+    pre_hook=[
+        "{{ delete_changed_months('yellow', 'yellow_taxi', 'co2_rollup_yellow', 'cab_type') }}",
+        "{{ delete_changed_months('green', 'green_taxi', 'co2_rollup_green', 'cab_type') }}"
+    ],
+    post_hook=[
+        "{{ record_watermark('yellow', 'yellow_taxi', 'co2_rollup_yellow') }}",
+        "{{ record_watermark('green', 'green_taxi', 'co2_rollup_green') }}"
+    ]
+) }}
+
+{% set cabs = [
+    ('yellow', 'yellow_taxi', 'tpep_pickup_datetime', 'transformed_yellow'),
+    ('green', 'green_taxi', 'lpep_pickup_datetime', 'transformed_green')
+] %}
+
+{% for cab_type, vehicle_type, pickup_col, model in cabs %}
+select
+    {{ compact_cast("'" ~ cab_type ~ "'", "enum('yellow', 'green')") }} as cab_type,
+    pickup_month,
+    {{ compact_cast('extract(year from ' ~ pickup_col ~ ')', 'usmallint') }} as year,
+    month_of_year,
+    week_of_year,
+    day_of_week,
+    hour_of_day,
+    count(*) as trip_count,
+    sum(trip_co2_kgs) as co2_sum,
+    count(trip_co2_kgs) as co2_count,
+    max(trip_co2_kgs) as co2_max,
+    arg_max(trip_distance, trip_co2_kgs) as co2_max_trip_distance,
+    sum(avg_mph) as mph_sum,
+    count(avg_mph) as mph_count,
+    max(avg_mph) as mph_max
+from {{ ref(model) }}
+{% if is_incremental() %}
+where {{ changed_months(cab_type, vehicle_type, 'co2_rollup_' ~ cab_type) }}
+{% endif %}
+group by all
+{% if not loop.last %}union all{% endif %}
+{% endfor %}
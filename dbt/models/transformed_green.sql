@@ -1,13 +1,30 @@
--- joins yellow with emissions table where vehicle type matches, extracts calculations for co2 and hour/day/week/month into 5 new columns
+-- incremental by pickup month: only months rebuilt by clean.py since the last run are re-transformed
+-- a change to the green_taxi co2 factor reprocesses every month (or use dbt run --full-refresh)
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key='pickup_month',
+    pre_hook="{{ delete_changed_months('green', 'green_taxi') }}",
+    post_hook="{{ record_watermark('green', 'green_taxi') }}"
+) }}
+
+-- joins green with emissions table where vehicle type matches, extracts calculations for co2 and hour/day/week/month into 5 new columns
 -- includes error handling for dividing by 0
+-- compact_cast / clean_columns only change types and columns under --vars '{compact: true}'
 select
-    y.*,
-    (y.trip_distance * e.co2_grams_per_mile / 1000.0) as trip_co2_kgs,
-    (y.trip_distance / nullif(y.trip_duration_s / 3600.0, 0)) as avg_mph,
-    extract(hour from y.tpep_pickup_datetime) as hour_of_day,
-    extract(dow from y.tpep_pickup_datetime) as day_of_week,
-    extract(week from y.tpep_pickup_datetime) as week_of_year,
-    extract(month from y.tpep_pickup_datetime) as month_of_year
-from yellow_clean y
+    {{ clean_columns('g', 'lpep_dropoff_datetime') }},
+    {{ compact_cast('g.trip_distance * e.co2_grams_per_mile / 1000.0', 'float') }} as trip_co2_kgs,
+    {{ compact_cast('g.trip_distance / nullif(g.trip_duration_s / 3600.0, 0)', 'float') }} as avg_mph,
+    {{ compact_cast('extract(hour from g.lpep_pickup_datetime)', 'utinyint') }} as hour_of_day,
+    {{ compact_cast('extract(dow from g.lpep_pickup_datetime)', 'utinyint') }} as day_of_week,
+    {{ compact_cast('extract(week from g.lpep_pickup_datetime)', 'utinyint') }} as week_of_year,
+    {{ compact_cast('extract(month from g.lpep_pickup_datetime)', 'utinyint') }} as month_of_year
+from green_clean g
 join emissions e
-  on e.vehicle_type = 'yellow_taxi'
+  on e.vehicle_type = 'green_taxi'
+{% if is_incremental() %}
+where {{ changed_months('green', 'green_taxi') }}
+{% endif %}
+-- stored in pickup order, so every row group covers a narrow time range and date-filtered analysis queries skip
+-- the others through DuckDB's min/max zone maps (incremental runs append each rebuilt month in order too)
+order by g.lpep_pickup_datetime
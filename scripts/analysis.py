@@ -1,7 +1,18 @@
-import duckdb
+import argparse
+import datetime
+import json
 import logging
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from profiling import StageMetrics, query_helper
+from queries import (rollup_table, cab_types, pickup_cols, question_columns, trip_sources, use_lake, relation,
+                     month_aligned, date_conditions, where_clause, date_range_label, largest_trip_query,
+                     average_co2_query, monthly_totals_query)
+from result_cache import ResultCache, default_result_dir, digest
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
@@ -9,6 +20,52 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Pre-aggregated cube built by dbt (models/co2_rollup.sql) - answers every question below from thousands of rows
+# Pass use_rollup=False to compute from the transformed trip tables instead
+# Modes for run_analysis: rollup (default), trips (one query per question), single-pass (one query per table)
+# or approx (single pass over a sample of the trips, with confidence intervals)
+# Query functions return Arrow tables; they are only converted to pandas when printed or plotted
+# The SQL itself is built in queries.py, which serve.py shares
+
+# Persistent result cache (result_cache.py), keyed on the version of the table each query reads; set by run_analysis
+result_cache = None
+table_versions = {}
+
+# Version of a table: how far its dbt models have transformed and with which co2 factor, its column types,
+# row count and latest month (transformed_at is left out, a dbt run that changed nothing keeps the cache)
+# Lake tables are versioned by the export manifest
+def table_version(con, table):
+    if table in trip_sources:
+        manifest = os.path.join(trip_sources[table].split("/cab_type=")[0], "_manifest.json")
+        with open(manifest) as f:
+            return digest(table, json.load(f)[cab_types[table]])
+    watermarks = con.execute(
+        "SELECT model_name, cleaned_through, co2_grams_per_mile FROM transform_watermarks "
+        "WHERE model_name LIKE ? ORDER BY model_name", [f"{table}%"]
+    ).fetchall()
+    columns = con.execute(
+        "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ? ORDER BY ordinal_position",
+        [table]
+    ).fetchall()
+    shape = con.execute(f"SELECT COUNT(*), MAX(pickup_month) FROM {table}").fetchone()
+    return digest(table, watermarks, columns, shape)
+
+def use_result_cache(con, cache, tables):
+    global result_cache
+    result_cache = cache
+    for table in tables:
+        try:
+            table_versions[table] = table_version(con, table)
+        except Exception as e:
+            logger.warning(f"No version for {table}, its results are not cached: {e}")
+
+# Runs a query that reads `table` as an Arrow table, through the result cache when there is one
+@query_helper
+def fetch_arrow(con, query, table):
+    if result_cache is None or table not in table_versions:
+        return con.execute(query).to_arrow_table()
+    return result_cache.fetch(con, query, table_versions[table])
+
 '''
 1. What was the single largest carbon producing trip of the year for YELLOW and GREEN trips? (One result for each type)
 2. Across the entire year, what on average are the most carbon heavy and carbon light hours of the day for YELLOW and for GREEN trips? (1-24)
@@ -20,141 +77,112 @@ along the X-axis and CO2 totals along the Y-axis. Render two lines/bars/plots of
 '''
 
 # Q1 Function - takes in both yellow and green tables as input and selects largest carbon producing trip from each
-# Value is converted to a data frame for the table with one element
-def largest_trip(con, table):
+# Value is returned as an Arrow table with one row
+def largest_trip(con, table, use_rollup=True, start=None, end=None):
     try:
-        result = con.execute(f"""
-            SELECT trip_distance, trip_co2_kgs
-            FROM {table}
-            ORDER BY trip_co2_kgs DESC
-            LIMIT 1
-            ;
-        """).fetchdf()
+        query = largest_trip_query(table, use_rollup, start, end)
+        result = fetch_arrow(con, query, rollup_table if use_rollup else table)
         logger.info(f"[{table}] Largest trip query ran successfully")
         return result
     except Exception as e:
         logger.error(f"[{table}] Largest trip query failed: {e}")
-        return pd.DataFrame()
+        return pa.table({})
 
 # Q2 Function - takes in both yellow and green tables as input and finds average most heavy and light carbon usage hours of the day
-# Averages are converted to a data frame which contains all averages in descending order to be selected from when function is implemented
-def heavy_light_hours(con, table):
+# Averages are returned as an Arrow table which contains all averages in descending order to be selected from when function is implemented
+def heavy_light_hours(con, table, use_rollup=True, start=None, end=None):
     try:
-        result = con.execute(f"""
-            SELECT hour_of_day, AVG(trip_co2_kgs) AS avg_co2
-            FROM {table}
-            GROUP BY hour_of_day
-            ORDER BY avg_co2 DESC
-            ;
-            """).fetchdf()
+        result = fetch_arrow(con, average_co2_query(table, "hour_of_day", use_rollup, start, end),
+                             rollup_table if use_rollup else table)
         logger.info(f"[{table}] Heavy/Light hours query ran")
         return result
     except Exception as e: 
             logger.error(f"[{table}] Heavy/light hours query failed: {e}")
-            return pd.DataFrame()
+            return pa.table({})
 
 # Q3 Function - takes in both yellow and green tables as input and finds average most heavy and light carbon usage days of the week
-# Averages are converted to a data frame which contains all averages in descending order to be selected from when function is implemented
-def heavy_light_days(con, table):
+# Averages are returned as an Arrow table which contains all averages in descending order to be selected from when function is implemented
+def heavy_light_days(con, table, use_rollup=True, start=None, end=None):
     try:
-        result = con.execute(f"""
-            SELECT day_of_week, AVG(trip_co2_kgs) AS avg_co2
-            FROM {table}
-            GROUP BY day_of_week
-            ORDER BY avg_co2 DESC
-            ;
-            """).fetchdf()
+        result = fetch_arrow(con, average_co2_query(table, "day_of_week", use_rollup, start, end),
+                             rollup_table if use_rollup else table)
         logger.info(f"[{table}] Heavy/Light days query ran")
         return result
     except Exception as e: 
             logger.error(f"[{table}] Heavy/light days query failed: {e}")
-            return pd.DataFrame()
+            return pa.table({})
     
 # Q4 Function - takes in both yellow and green tables as input and finds average most heavy and light carbon usage days of the week
-# Averages are converted to a data frame which contains all averages in descending order to be selected from when function is implemented
-def heavy_light_weeks(con, table):
+# Averages are returned as an Arrow table which contains all averages in descending order to be selected from when function is implemented
+def heavy_light_weeks(con, table, use_rollup=True, start=None, end=None):
     try:
-        result = con.execute(f"""
-            SELECT week_of_year, AVG(trip_co2_kgs) AS avg_co2
-            FROM {table}
-            GROUP BY week_of_year
-            ORDER BY avg_co2 DESC
-            ;
-            """).fetchdf()
+        result = fetch_arrow(con, average_co2_query(table, "week_of_year", use_rollup, start, end),
+                             rollup_table if use_rollup else table)
         logger.info(f"[{table}] Heavy/Light weeks query ran")
         return result
     except Exception as e: 
             logger.error(f"[{table}] Heavy/light weeks query failed: {e}")
-            return pd.DataFrame()
+            return pa.table({})
 
 # Q5 Function - takes in both yellow and green tables as input and finds average most heavy and light carbon usage months of the year
-# Averages are converted to a data frame which contains all averages in descending order to be selected from when function is implemented
-def heavy_light_months(con, table):
+# Averages are returned as an Arrow table which contains all averages in descending order to be selected from when function is implemented
+def heavy_light_months(con, table, use_rollup=True, start=None, end=None):
     try:
-        result = con.execute(f"""
-            SELECT month_of_year, AVG(trip_co2_kgs) AS avg_co2
-            FROM {table}
-            GROUP BY month_of_year
-            ORDER BY avg_co2 DESC
-            ;
-            """).fetchdf()
+        result = fetch_arrow(con, average_co2_query(table, "month_of_year", use_rollup, start, end),
+                             rollup_table if use_rollup else table)
         logger.info(f"[{table}] Heavy/Light months query ran")
         return result
     except Exception as e: 
             logger.error(f"[{table}] Heavy/light months query failed: {e}")
-            return pd.DataFrame()
+            return pa.table({})
     
+# Monthly co2 totals for one table, used by the plots
+def monthly_totals(con, table, use_rollup=True, start=None, end=None):
+    query = monthly_totals_query(table, use_rollup, start, end)
+    return fetch_arrow(con, query, rollup_table if use_rollup else table)
+
 # Q6 Function - plot 
 # Generates and saves as png two line plots of carbon usage by month for each table (yellow and green)
 # Commented out is the version I used to generate the plots for 2024 only
-def generate_plots(con):
+# monthly can hold already fetched monthly totals per table (Arrow tables, x axis label built in SQL as year_month)
+# suffix is added to the file names (approx mode plots estimated totals next to the exact ones)
+# With the result cache on, a plot whose data hasn't changed since it was drawn is left as it is
+# tables limits the plots to some cab types, start/end to a pickup date range (named in the title)
+def generate_plots(con, use_rollup=True, monthly=None, suffix="", tables=None, start=None, end=None):
+    period = "2015-2024" if start is None and end is None else date_range_label(start, end)
     try:
-       
-        # Yellow Plot
-        yellow_df = con.execute("""
-            SELECT 
-            EXTRACT(YEAR FROM tpep_pickup_datetime) AS year,
-            month_of_year, 
-            SUM(trip_co2_kgs) AS total_co2
-            FROM transformed_yellow
-            GROUP BY year, month_of_year
-            ORDER BY year, month_of_year;
-        """).fetchdf()
-    
-        # Adjust x axis to reflect month AND year 
-        yellow_df["year_month"] = yellow_df["year"].astype(int).astype(str) + "-" + yellow_df["month_of_year"].astype(int).astype(str)
-        yellow_df.plot(kind="line", x="year_month", y="total_co2", marker="o", figsize=(12, 5))
-        plt.title("Total CO2 Emissions by Month (2015-2024) - Yellow Cabs")
-        plt.xlabel("Year-Month")
-        plt.ylabel("Total CO2 (kg)")
-        plt.grid(True)
-        plt.savefig("co2_by_month_yellow.png")
-        plt.close()
-        print("Saved plot as co2_by_month_yellow.png")
-        logger.info("Saved plot co2_by_month_yellow.png")
+        for table in ["transformed_yellow", "transformed_green"] if tables is None else tables:
+            cab = cab_types[table]
+            if monthly is not None and table in monthly:
+                totals = monthly[table]
+            else:
+                totals = monthly_totals(con, table, use_rollup, start, end)
 
-        # Green plot 
-        green_df = con.execute("""
-            SELECT 
-            EXTRACT(YEAR FROM lpep_pickup_datetime) AS year,
-            month_of_year, 
-            SUM(trip_co2_kgs) AS total_co2
-            FROM transformed_green
-            GROUP BY year, month_of_year
-            ORDER BY year, month_of_year;
-        """).fetchdf()
+            path = f"co2_by_month_{cab}{suffix}.png"
+            if totals.num_rows == 0:
+                print(f"No trips in range for {cab} cabs, {path} not plotted")
+                logger.info(f"No monthly totals for {table}, {path} not plotted")
+                continue
+            plotted = totals.select(["year_month", "total_co2"])
+            data_digest = digest(plotted.to_pylist())
+            if result_cache is not None and result_cache.plot_is_current(path, data_digest):
+                print(f"Plot {path} is up to date")
+                logger.info(f"Plot {path} unchanged, not redrawn")
+                continue
 
-        # Again adjust x axis to reflect month AND year 
-        green_df["year_month"] = green_df["year"].astype(int).astype(str) + "-" + green_df["month_of_year"].astype(int).astype(str)
-        green_df.plot(kind="line", x="year_month", y="total_co2", marker="o", figsize=(12, 5))
-        plt.title("Total CO2 Emissions by Month (2015-2024) - Green Cabs")
-        plt.xlabel("Year-Month")
-        plt.ylabel("Total CO2 (kg)")
-        plt.grid(True)
-        plt.savefig("co2_by_month_green.png")
-        plt.close()
-        print("Saved plot as co2_by_month_green.png")
-        logger.info("Saved plot co2_by_month_green.png")
+            # x axis reflects month AND year, only the two plotted columns are converted to pandas
+            df = plotted.to_pandas()
+            df.plot(kind="line", x="year_month", y="total_co2", marker="o", figsize=(12, 5))
+            plt.title(f"Total CO2 Emissions by Month ({period}) - {cab.capitalize()} Cabs")
+            plt.xlabel("Year-Month")
+            plt.ylabel("Total CO2 (kg)")
+            plt.grid(True)
+            plt.savefig(path)
+            plt.close()
+            if result_cache is not None:
+                result_cache.record_plot(path, data_digest)
+            print(f"Saved plot as {path}")
+            logger.info(f"Saved plot {path}")
 
         # Below is my code for just 2024 plots 
         '''
@@ -199,42 +227,442 @@ def generate_plots(con):
         
         '''
     except Exception as e: 
-        logger.error("Plots failed. :( ")
+        logger.error(f"Plots failed. :( {e}")
 
-# Main analysis function - implements all of above 
-# Returns printed results for table (transformed_green and transformed_yellow), renders plots and saves as png
-def run_analysis(): 
-    con = duckdb.connect(database="emissions.duckdb", read_only=True)
-    logger.info("Connected to DuckDB")
+# Single-pass engine - answers Q1-Q5 plus the monthly totals for the plot with one scan of a trip table
+# GROUPING SETS computes every grouping in the same pass; the grand total row carries the largest trip (arg_max)
+# The result is split back into the same per-question tables the functions above return
+def single_pass_answers(con, table, start=None, end=None):
+    try:
+        sets = ", ".join(f"({column})" for column in question_columns.values())
+        result = fetch_arrow(con, f"""
+            SELECT
+                GROUPING(hour_of_day, day_of_week, week_of_year, month_of_year, year) AS grouping_id,
+                hour_of_day, day_of_week, week_of_year, month_of_year, year,
+                printf('%d-%d', year, month_of_year) AS year_month,
+                AVG(trip_co2_kgs) AS avg_co2,
+                SUM(trip_co2_kgs) AS total_co2,
+                arg_max(trip_distance, trip_co2_kgs) AS trip_distance,
+                MAX(trip_co2_kgs) AS trip_co2_kgs
+            FROM (
+                SELECT hour_of_day, day_of_week, week_of_year, month_of_year,
+                       EXTRACT(YEAR FROM {pickup_cols[table]}) AS year,
+                       trip_distance, trip_co2_kgs
+                FROM {relation(table)}
+                {where_clause(*date_conditions(table, start, end))}
+            )
+            GROUP BY GROUPING SETS ({sets}, (year, month_of_year), ())
+            ;
+        """, table)
+        logger.info(f"[{table}] Single-pass query ran")
+    except Exception as e:
+        logger.error(f"[{table}] Single-pass query failed: {e}")
+        return {}
 
-    tables = ["transformed_green", "transformed_yellow"]
+    # GROUPING() sets a bit for every column not in the grouping, so each set has its own id
+    all_columns = ["hour_of_day", "day_of_week", "week_of_year", "month_of_year", "year"]
+    def grouping_rows(*grouped):
+        grouping_id = sum(1 << (len(all_columns) - 1 - i) for i, column in enumerate(all_columns) if column not in grouped)
+        return result.filter(pc.equal(result["grouping_id"], grouping_id))
 
-    for table in tables:
-        
-        print(f"\nAnswers for Table {table}: ")
+    answers = {"largest": grouping_rows().select(["trip_distance", "trip_co2_kgs"])}
+    for name, column in question_columns.items():
+        answers[name] = (
+            grouping_rows(column)
+            .select([column, "avg_co2"])
+            .sort_by([("avg_co2", "descending"), (column, "ascending")])
+        )
+    answers["monthly"] = (
+        grouping_rows("year", "month_of_year")
+        .select(["year", "month_of_year", "year_month", "total_co2"])
+        .sort_by([("year", "ascending"), ("month_of_year", "ascending")])
+    )
+    return answers
+
+# Per-question path - one query for each of Q1-Q5, plus the monthly totals for the plot
+def per_question_answers(con, table, use_rollup=True, start=None, end=None):
+    return {
+        "largest": largest_trip(con, table, use_rollup, start, end),
+        "hours": heavy_light_hours(con, table, use_rollup, start, end),
+        "days": heavy_light_days(con, table, use_rollup, start, end),
+        "weeks": heavy_light_weeks(con, table, use_rollup, start, end),
+        "months": heavy_light_months(con, table, use_rollup, start, end),
+        "monthly": monthly_totals(con, table, use_rollup, start, end),
+    }
+
+# Checks the single-pass engine against the per-question queries on the trip table
+# Returns True when every answer matches (floats compared with a small tolerance)
+def check_single_pass(con, table, start=None, end=None):
+    expected = per_question_answers(con, table, use_rollup=False, start=start, end=end)
+    actual = single_pass_answers(con, table, start, end)
+    ok = True
+    for name, expected_table in expected.items():
+        try:
+            frame = expected_table.to_pandas()
+            pd.testing.assert_frame_equal(
+                frame.sort_values(list(frame.columns)).reset_index(drop=True),
+                actual[name].to_pandas()[list(frame.columns)].sort_values(list(frame.columns)).reset_index(drop=True),
+                check_dtype=False, rtol=1e-9,
+            )
+        except (AssertionError, KeyError) as e:
+            ok = False
+            logger.error(f"[{table}] Single-pass mismatch for {name}: {e}")
+            print(f"[{table}] Single-pass mismatch for {name}")
+    print(f"[{table}] Single-pass check {'passed' if ok else 'FAILED'}")
+    logger.info(f"[{table}] Single-pass check {'passed' if ok else 'failed'}")
+    return ok
+
+# Checks that the transformed table (and the rollup) hold the same number of trips per pickup month as the cleaned
+# table, so a month clean.py emptied or rebuilt can't linger in the answers after dbt has run
+# Returns True when every month matches
+def check_transformed_months(con, table, has_rollup=True):
+    cab = cab_types[table]
+    rollup = f"""
+        UNION ALL
+        SELECT 'rollup', pickup_month, SUM(trip_count) FROM {rollup_table} WHERE cab_type = '{cab}' GROUP BY pickup_month
+    """ if has_rollup else ""
+    mismatched = con.execute(f"""
+        SELECT pickup_month,
+               SUM(trips) FILTER (WHERE source = 'clean') AS clean_trips,
+               SUM(trips) FILTER (WHERE source = 'transformed') AS transformed_trips,
+               SUM(trips) FILTER (WHERE source = 'rollup') AS rollup_trips
+        FROM (
+            SELECT 'clean' AS source, pickup_month, COUNT(*) AS trips FROM {cab}_clean GROUP BY pickup_month
+            UNION ALL
+            SELECT 'transformed', pickup_month, COUNT(*) FROM {table} GROUP BY pickup_month
+            {rollup}
+        )
+        GROUP BY pickup_month
+        HAVING clean_trips IS DISTINCT FROM transformed_trips
+            OR ({has_rollup} AND clean_trips IS DISTINCT FROM rollup_trips)
+        ORDER BY pickup_month
+    """).fetchall()
+    for month, clean_trips, transformed_trips, rollup_trips in mismatched:
+        print(f"[{table}] Pickup month {month}: {clean_trips or 0} cleaned trips, {transformed_trips or 0} transformed"
+              + (f", {rollup_trips or 0} in {rollup_table}" if has_rollup else ""))
+        logger.error(f"[{table}] Pickup month {month} differs from {cab}_clean: "
+                     f"{clean_trips} cleaned, {transformed_trips} transformed, {rollup_trips} rolled up")
+    ok = not mismatched
+    print(f"[{table}] Transformed months check {'passed' if ok else 'FAILED (run dbt if clean.py ran since)'}")
+    logger.info(f"[{table}] Transformed months check {'passed' if ok else 'failed'}")
+    return ok
+
+# Approximate mode - the single-pass questions over a sample of the trips
+# system sampling reads whole blocks of 2048 rows and skips the rest (fast), bernoulli/reservoir sample single rows
+# Rows of one block are not independent, so the 95% intervals come from the variance between sampled blocks
+# (ratio estimator over blocks), which holds for every sampling method
+# Monthly totals are scaled up by total rows / sampled rows; Q1 is the largest trip in the sample (a lower bound)
+sample_block_rows = 2048
+# two-sided 95% Student t quantiles by degrees of freedom (sampled blocks - 1); groups seen in few blocks get wide intervals
+t_quantiles = [None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+               2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+               2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+def t_quantile(df):
+    if df < len(t_quantiles):
+        return t_quantiles[df]
+    return 2.000 if df <= 60 else 1.980 if df <= 120 else 1.960
+co2_quantiles = [0.1, 0.5, 0.9]
+
+# Block of each trip: its storage vector in a DuckDB table, or file and row range in the lake
+def block_key(table):
+    if table in trip_sources:
+        return f"hash(filename, file_row_number // {sample_block_rows})"
+    return f"rowid // {sample_block_rows}"
+
+# start/end sample within a pickup date range (the sample is drawn first, then filtered)
+def approximate_answers(con, table, rate=1.0, method="system", seed=42, start=None, end=None):
+    sample = f"TABLESAMPLE {rate} PERCENT ({method}, {seed})"
+    dates = where_clause(*date_conditions(table, start, end))
+    sampled = f"""
+        SELECT hour_of_day, day_of_week, week_of_year, month_of_year,
+               EXTRACT(YEAR FROM {pickup_cols[table]}) AS year,
+               trip_distance, trip_co2_kgs, {block_key(table)} AS block
+        FROM {relation(table, row_numbers=True)} {sample}
+        {dates}
+    """
+    sets = ", ".join(f"({column}, block)" for column in question_columns.values())
+    try:
+        total_rows = con.execute(f"SELECT COUNT(*) FROM {relation(table)} {dates}").fetchone()[0]
+        # per block sums first, then mean and between-block variance of every group
+        result = fetch_arrow(con, f"""
+            WITH blocks AS (
+                SELECT
+                    GROUPING(hour_of_day, day_of_week, week_of_year, month_of_year, year) AS grouping_id,
+                    hour_of_day, day_of_week, week_of_year, month_of_year, year,
+                    SUM(trip_co2_kgs) AS s, COUNT(trip_co2_kgs) AS n, COUNT(*) AS trips,
+                    arg_max(trip_distance, trip_co2_kgs) AS max_distance, MAX(trip_co2_kgs) AS max_co2
+                FROM ({sampled})
+                GROUP BY GROUPING SETS ({sets}, (year, month_of_year, block), (block))
+            ),
+            groups AS (
+                SELECT grouping_id, hour_of_day, day_of_week, week_of_year, month_of_year, year,
+                       SUM(s) AS s, SUM(n) AS n, SUM(trips) AS trips, COUNT(*) AS blocks,
+                       SUM(s * s) AS ss, SUM(s * n) AS sn, SUM(n * n) AS nn,
+                       arg_max(max_distance, max_co2) AS trip_distance, MAX(max_co2) AS trip_co2_kgs
+                FROM blocks
+                GROUP BY ALL
+            )
+            SELECT grouping_id, hour_of_day, day_of_week, week_of_year, month_of_year, year,
+                   printf('%d-%d', year, month_of_year) AS year_month,
+                   s / n AS avg_co2,
+                   sqrt(greatest(
+                       CASE WHEN blocks > 1
+                            THEN blocks / (blocks - 1) * (ss - 2 * (s / n) * sn + (s / n) * (s / n) * nn) / (n * n)
+                       END, 0)
+                   ) AS std_error,
+                   s AS sample_co2, trips, blocks, trip_distance, trip_co2_kgs
+            FROM groups
+            ;
+        """, table)
+        quantiles = fetch_arrow(con, f"""
+            SELECT GROUPING(hour_of_day, month_of_year) AS grouping_id, hour_of_day, month_of_year,
+                   approx_quantile(trip_co2_kgs, {co2_quantiles}) AS co2_quantiles
+            FROM ({sampled})
+            GROUP BY GROUPING SETS ((hour_of_day), (month_of_year))
+            ORDER BY ALL
+            ;
+        """, table)
+        logger.info(f"[{table}] Approximate query ran ({rate}% {method} sample)")
+    except Exception as e:
+        logger.error(f"[{table}] Approximate query failed: {e}")
+        return {}
+
+    all_columns = ["hour_of_day", "day_of_week", "week_of_year", "month_of_year", "year"]
+    def grouping_rows(*grouped):
+        grouping_id = sum(1 << (len(all_columns) - 1 - i) for i, column in enumerate(all_columns) if column not in grouped)
+        return result.filter(pc.equal(result["grouping_id"], grouping_id))
+
+    overall = grouping_rows()
+    sampled_rows = overall["trips"][0].as_py() if overall.num_rows else 0
+    if not sampled_rows:
+        logger.warning(f"[{table}] {rate}% {method} sample is empty")
+        print(f"[{table}] The {rate}% {method} sample is empty, use a higher --sample-rate")
+        return {}
+    scale = total_rows / sampled_rows
+    answers = {
+        "sample": {"rate": rate, "method": method, "rows": sampled_rows, "total_rows": total_rows,
+                   "blocks": overall["blocks"][0].as_py()},
+        "largest": overall.select(["trip_distance", "trip_co2_kgs"]),
+    }
+    for name, column in question_columns.items():
+        rows = grouping_rows(column).sort_by([("avg_co2", "descending"), (column, "ascending")])
+        # no interval (NULL) for a group seen in a single block
+        margin = pa.array([
+            None if error is None or t_quantile(blocks - 1) is None else error * t_quantile(blocks - 1)
+            for error, blocks in zip(rows["std_error"].to_pylist(), rows["blocks"].to_pylist())
+        ], pa.float64())
+        rows = rows.append_column("margin", margin)
+        answers[name] = pa.table({
+            column: rows[column],
+            "avg_co2": rows["avg_co2"],
+            "ci_low": pc.subtract(rows["avg_co2"], rows["margin"]),
+            "ci_high": pc.add(rows["avg_co2"], rows["margin"]),
+            "trips": rows["trips"],
+        })
+    monthly = grouping_rows("year", "month_of_year").sort_by([("year", "ascending"), ("month_of_year", "ascending")])
+    answers["monthly"] = pa.table({
+        "year": monthly["year"],
+        "month_of_year": monthly["month_of_year"],
+        "year_month": monthly["year_month"],
+        "total_co2": pc.multiply(monthly["sample_co2"], scale),
+    })
+    # GROUPING(hour_of_day, month_of_year) is 1 for the hour set and 2 for the month set
+    for name, column, grouping_id in [("hours", "hour_of_day", 1), ("months", "month_of_year", 2)]:
+        rows = quantiles.filter(pc.equal(quantiles["grouping_id"], grouping_id))
+        answers[f"quantiles_{name}"] = rows.select([column, "co2_quantiles"])
+    return answers
 
-        largest = largest_trip(con, table)
-        print(f"(Q1) Largest CO₂ trip:\n{largest.to_string(index=False)}")
+# A heavy/light answer is unstable when its interval overlaps the runner-up's, so another sample could swap them
+# (or when either has no interval)
+def unstable_rankings(frame):
+    if "ci_low" not in frame.columns or len(frame) < 2:
+        return False, False
+    # positions in the ranking, the higher ranked one first
+    def overlaps(higher, lower):
+        pair = frame.iloc[[higher, lower]]
+        if pair[["ci_low", "ci_high"]].isna().any().any():
+            return True
+        return pair.iloc[0]["ci_low"] <= pair.iloc[1]["ci_high"]
+    return bool(overlaps(0, 1)), bool(overlaps(-2, -1))
 
-        hours = heavy_light_hours(con, table)
-        print(f"(Q2) Heavy hour: {hours.iloc[0]['hour_of_day']} ({hours.iloc[0]['avg_co2']:.2f} kg)")
-        print(f"(Q2) Light hour: {hours.iloc[-1]['hour_of_day']} ({hours.iloc[-1]['avg_co2']:.2f} kg)")
+# Checks the approximate answers against the exact ones: how many exact averages fall inside their interval
+# Groups missing from the sample or seen in a single block have no interval and are counted separately
+# Returns the fraction covered (about 0.95 expected)
+def check_approximate(con, table, answers, use_rollup=True, start=None, end=None):
+    exact = per_question_answers(con, table, use_rollup, start, end)
+    covered = with_interval = groups = 0
+    for name, column in question_columns.items():
+        groups += exact[name].num_rows
+        joined = answers[name].join(exact[name].rename_columns([column, "exact_co2"]), column)
+        joined = joined.filter(pc.is_valid(joined["ci_low"]))
+        inside = pc.and_(pc.greater_equal(joined["exact_co2"], joined["ci_low"]),
+                         pc.less_equal(joined["exact_co2"], joined["ci_high"]))
+        covered += pc.sum(inside).as_py() or 0
+        with_interval += joined.num_rows
+    coverage = covered / with_interval if with_interval else 0.0
+    print(f"[{table}] {covered} of {with_interval} exact averages inside their 95% interval ({coverage:.0%}), "
+          f"{groups - with_interval} of {groups} groups without an interval")
+    logger.info(f"[{table}] Approximate check: {covered} of {with_interval} exact averages inside their interval, "
+                f"{groups - with_interval} groups without one")
+    return coverage
+
+# Worker - answers every question for one table on its own cursor, so tables can run concurrently
+def analyze_table(con, table, mode, sample=None, start=None, end=None):
+    cursor = con.cursor()
+    try:
+        if mode == "approx":
+            return approximate_answers(cursor, table, **(sample or {}), start=start, end=end)
+        if mode == "single-pass":
+            return single_pass_answers(cursor, table, start, end)
+        return per_question_answers(cursor, table, mode == "rollup", start, end)
+    finally:
+        cursor.close()
 
-        days = heavy_light_days(con, table)
-        print(f"(Q3) Heavy day: {days.iloc[0]['day_of_week']} ({days.iloc[0]['avg_co2']:.2f} kg)")
-        print(f"(Q3) Light day: {days.iloc[-1]['day_of_week']} ({days.iloc[-1]['avg_co2']:.2f} kg)")
+# Prints the answers for one table WITH a label explaining each value (pandas only here, at the edge)
+def print_answers(table, answers):
+    print(f"\nAnswers for Table {table}: ")
+    if not answers:
+        print("No answers, see analysis.log")
+        return
 
-        weeks = heavy_light_weeks(con, table)
-        print(f"(Q4) Heavy week: {weeks.iloc[0]['week_of_year']} ({weeks.iloc[0]['avg_co2']:.2f} kg)")
-        print(f"(Q4) Light week: {weeks.iloc[-1]['week_of_year']} ({weeks.iloc[-1]['avg_co2']:.2f} kg)")
+    sample = answers.get("sample")
+    if sample:
+        print(f"Approximate: {sample['rate']}% {sample['method']} sample, {sample['rows']} of {sample['total_rows']} trips "
+              f"in {sample['blocks']} blocks, 95% intervals")
 
-        months = heavy_light_months(con, table)
-        print(f"(Q5) Heavy month: {months.iloc[0]['month_of_year']} ({months.iloc[0]['avg_co2']:.2f} kg)")
-        print(f"(Q5) Light month: {months.iloc[-1]['month_of_year']} ({months.iloc[-1]['avg_co2']:.2f} kg)")
+    largest = answers["largest"].to_pandas()
+    # aggregates over no trips still return one row, of NULLs
+    if largest.empty or largest["trip_co2_kgs"].isna().all():
+        print("No trips in range")
+        return
+    print(f"(Q1) Largest CO₂ trip{' in the sample (exact value is at least this)' if sample else ''}:\n{largest.to_string(index=False)}")
 
-    # Run and save plot outputs (Q6) 
-    generate_plots(con)
+    for number, (name, label) in enumerate([("hours", "hour"), ("days", "day"), ("weeks", "week"), ("months", "month")], start=2):
+        frame = answers[name].to_pandas()
+        column = question_columns[name]
+        if frame.empty:
+            print(f"(Q{number}) No trips in range, see analysis.log")
+            continue
+        unstable = unstable_rankings(frame)
+        for position, end, flag in [(0, "Heavy", unstable[0]), (-1, "Light", unstable[1])]:
+            row = frame.iloc[position]
+            interval = ""
+            if sample:
+                interval = " [no interval, one sampled block]" if pd.isna(row["ci_low"]) else f" [{row['ci_low']:.2f}, {row['ci_high']:.2f}]"
+            print(f"(Q{number}) {end} {label}: {row[column]} ({row['avg_co2']:.2f} kg{interval})"
+                  + (" UNSTABLE - overlaps the runner-up" if flag else ""))
+
+    for name, label in [("quantiles_hours", "hour"), ("quantiles_months", "month")]:
+        if name in answers:
+            frame = answers[name].to_pandas()
+            column = frame.columns[0]
+            print(f"CO₂ per trip by {label} (p10 / p50 / p90, kg):")
+            for _, row in frame.iterrows():
+                print(f"  {row[column]:>4}: " + " / ".join(f"{value:.2f}" for value in row["co2_quantiles"]))
+
+# Main analysis function - implements all of above 
+# Each table is analysed on its own cursor from a thread pool (workers=1 runs them one after another)
+# Returns printed results for table (transformed_green and transformed_yellow), renders plots and saves as png
+# With lake set, an in-memory DuckDB scans the Parquet lake and emissions.duckdb is never opened
+# sample holds rate (percent), method and seed for the approx mode
+# cache is a ResultCache: query results and plots are reused while the tables they read are unchanged
+# cabs limits the analysis to some cab types (yellow, green), start/end to a pickup date range (end exclusive)
+def run_analysis(mode="rollup", check=False, workers=2, lake=None, slow_query_ms=None, sample=None, cache=None,
+                 cabs=None, start=None, end=None):
+    metrics = StageMetrics("analysis", slow_ms=slow_query_ms)
+    if lake:
+        use_lake(lake)
+        con = metrics.connect()
+        logger.info(f"Reading trips from Parquet lake {lake}")
+        if mode == "rollup":
+            mode = "single-pass"
+    else:
+        con = metrics.connect(database="emissions.duckdb", read_only=True)
+        logger.info("Connected to DuckDB")
+
+    # fall back to the trip tables if dbt hasn't built the rollup yet
+    has_rollup = not lake and con.execute(
+        f"SELECT COUNT(*) FROM information_schema.tables WHERE table_name = '{rollup_table}'"
+    ).fetchone()[0] > 0
+    if mode == "rollup" and not has_rollup:
+        logger.warning(f"{rollup_table} not found, answering from the trip tables")
+        mode = "single-pass"
+    # the rollup only answers whole months
+    if mode == "rollup" and not month_aligned(start, end):
+        logger.info(f"{date_range_label(start, end)} is not whole months, answering from the trip tables")
+        mode = "single-pass"
+    if start is not None or end is not None:
+        print(f"Pickup dates: {date_range_label(start, end)} (end exclusive)")
+        logger.info(f"Filtering pickup dates {date_range_label(start, end)}")
+
+    tables = [table for table in ["transformed_green", "transformed_yellow"] if cabs is None or cab_types[table] in cabs]
+    if cache is not None:
+        use_result_cache(con, cache, tables + ([rollup_table] if has_rollup else []))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = dict(zip(tables, pool.map(lambda table: analyze_table(con, table, mode, sample, start, end), tables)))
+
+    for table in tables:
+        print_answers(table, results[table])
+        if check and mode == "approx":
+            if results[table]:
+                check_approximate(con, table, results[table], has_rollup and month_aligned(start, end), start, end)
+        elif check:
+            check_single_pass(con, table, start, end)
+        # the cleaned tables are only in emissions.duckdb
+        if check and not lake:
+            check_transformed_months(con, table, has_rollup)
+
+    # Run and save plot outputs (Q6) from the monthly totals fetched above (estimated totals get their own files)
+    # a date range gets its own files too, so the full-range plots are kept
+    suffix = "_approx" if mode == "approx" else ""
+    if start is not None or end is not None:
+        suffix += f"_{start or 'first'}_{end or 'last'}"
+    plot_tables = [table for table in ["transformed_yellow", "transformed_green"] if table in tables]
+    if mode == "approx":
+        # an empty or failed sample has no estimate to plot, and an exact scan must not be saved as *_approx.png
+        for table in [table for table in plot_tables if "monthly" not in results[table]]:
+            print(f"No approximate monthly totals for {table}, plot skipped")
+            logger.warning(f"[{table}] No approximate monthly totals, plot skipped")
+            plot_tables.remove(table)
+    generate_plots(con, mode == "rollup", {table: answers["monthly"] for table, answers in results.items() if "monthly" in answers},
+                   suffix=suffix, tables=plot_tables, start=start, end=end)
+    if cache is not None:
+        cache.log_stats()
+    con.close()
+    metrics.close()
 
 
 if __name__ == "__main__":
-    run_analysis()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Answer the CO2 questions for yellow and green trips")
+    parser.add_argument("--mode", choices=["rollup", "trips", "single-pass", "approx"], default="rollup",
+                        help="read the co2_rollup cube, run one query per question, one GROUPING SETS scan per table, or scan a sample")
+    parser.add_argument("--check", action="store_true",
+                        help="verify the single-pass answers against the per-question queries (approx: count exact averages inside the intervals)")
+    parser.add_argument("--sample-rate", type=float, default=1.0, help="approx mode: percent of trips sampled")
+    parser.add_argument("--sample-method", choices=["system", "bernoulli", "reservoir"], default="system",
+                        help="approx mode: system samples whole blocks (fastest), bernoulli/reservoir single rows")
+    parser.add_argument("--seed", type=int, default=42, help="approx mode: sample seed (same seed, same sample)")
+    parser.add_argument("--workers", type=int, default=2, help="tables analysed concurrently")
+    parser.add_argument("--cab", choices=["yellow", "green"], action="append",
+                        help="only analyse this cab type (repeat for both; default both)")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, help="first pickup date analysed (YYYY-MM-DD)")
+    parser.add_argument("--end", type=datetime.date.fromisoformat,
+                        help="pickup date where the analysis stops, exclusive (YYYY-MM-DD); whole months are answered from the rollup")
+    parser.add_argument("--lake", help="scan the Parquet lake written by export.py instead of emissions.duckdb (rollup mode becomes single-pass)")
+    parser.add_argument("--slow-query-ms", type=float, help="log the analysed plan of queries slower than this to analysis_metrics.jsonl")
+    parser.add_argument("--cache-dir", default=default_result_dir, help="query result cache")
+    parser.add_argument("--cache-max-mb", type=float, default=256, help="result cache size cap, least recently used results are evicted")
+    parser.add_argument("--no-cache", action="store_true", help="always run the queries and redraw the plots")
+    args = parser.parse_args()
+    if args.start and args.end and args.start >= args.end:
+        parser.error("--start must be before --end")
+
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_dir, max_bytes=int(args.cache_max_mb * 1024**2))
+
+    run_analysis(mode=args.mode, check=args.check, workers=args.workers, lake=args.lake, slow_query_ms=args.slow_query_ms,
+                 sample={"rate": args.sample_rate, "method": args.sample_method, "seed": args.seed}, cache=cache,
+                 cabs=args.cab, start=args.start, end=args.end)
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import requests
+
+# Local content-addressed cache for the trip-data parquet files
+# Blobs are stored by sha256 of their contents, index.json maps each url to its blob
+# No logging.basicConfig here - messages go to the log file of the script that imports it (load.log)
+
+logger = logging.getLogger(__name__)
+
+default_cache_dir = os.path.join(".cache", "tripdata")
+chunk_size = 8 * 1024 * 1024
+
+
+class ParquetCache:
+    def __init__(self, cache_dir=default_cache_dir, max_bytes=50 * 1024**3, verify=True):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.lock = threading.Lock()
+        self.in_use = {}
+        self.stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "bytes_downloaded": 0, "evicted": 0}
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    # index.json is replaced atomically so a crash never leaves it half written
+    def _write_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], f"{sha256}.parquet")
+
+    # Local path for a url, downloading on a miss
+    # probe (size/etag from the loader) invalidates entries whose source has changed
+    # limiter is only used when the network is actually hit
+    # Callers must release(url) once they have finished reading the file
+    def resolve(self, url, probe=None, limiter=None):
+        entry = self._lookup(url, probe)
+        if entry is not None:
+            return self.blob_path(entry["sha256"])
+
+        if limiter is not None:
+            limiter.acquire()
+        tmp_path, sha256, size, etag = self._download(url)
+        with self.lock:
+            # renamed into place and pinned under the lock, so an eviction of an older entry with the same
+            # contents can't delete the new file before it is indexed
+            path = self.blob_path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            self.in_use[url] = self.in_use.get(url, 0) + 1
+            self.stats["misses"] += 1
+            self.stats["bytes_downloaded"] += size
+            self.index[url] = {
+                "sha256": sha256,
+                "size": size,
+                "etag": etag or (probe or {}).get("etag"),
+                "last_access": time.time(),
+            }
+            self._evict()
+            self._write_index()
+        logger.info(f"Cache miss for {url} ({size} bytes downloaded)")
+        return path
+
+    def release(self, url):
+        with self.lock:
+            self._unpin(url)
+            # files pinned while the cache was over max_bytes can go now that they have been read
+            if url not in self.in_use:
+                cached = len(self.index)
+                self._evict()
+                if len(self.index) != cached:
+                    self._write_index()
+
+    def _unpin(self, url):
+        if self.in_use.get(url, 0) <= 1:
+            self.in_use.pop(url, None)
+        else:
+            self.in_use[url] -= 1
+
+    # A hit is pinned in the same locked block that finds it, so a concurrent miss can't evict the blob
+    # while its checksum is verified outside the lock
+    def _lookup(self, url, probe):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            path = self.blob_path(entry["sha256"])
+            stale = probe is not None and (
+                (probe.get("etag") and entry.get("etag") and probe["etag"] != entry["etag"])
+                or (probe.get("size_bytes") and probe["size_bytes"] != entry["size"])
+            )
+            if stale or not os.path.exists(path):
+                del self.index[url]
+                return None
+            self.in_use[url] = self.in_use.get(url, 0) + 1
+
+        # Checksum outside the lock so other workers aren't blocked while hashing
+        if self.verify and _sha256_file(path) != entry["sha256"]:
+            logger.warning(f"Checksum mismatch for cached {url}, discarding")
+            with self.lock:
+                self._unpin(url)
+                if self.index.get(url) is entry:
+                    del self.index[url]
+                    self._remove_blob_if_unused(entry["sha256"])
+            return None
+
+        with self.lock:
+            # dropped or replaced by another worker meanwhile: treat it as a miss
+            if self.index.get(url) is not entry:
+                self._unpin(url)
+                return None
+            entry["last_access"] = time.time()
+            self.stats["hits"] += 1
+            self.stats["bytes_saved"] += entry["size"]
+            self._write_index()
+        return entry
+
+    # Streams to a temp file in the cache dir while hashing; resolve() renames it into place
+    def _download(self, url):
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        try:
+            with requests.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                etag = response.headers.get("ETag")
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+            return tmp_path, digest.hexdigest(), size, etag
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    # Least recently used urls are dropped until the unique blobs fit under max_bytes
+    # Files still being read by a loader worker are never evicted
+    def _evict(self):
+        blobs = {}
+        for entry in self.index.values():
+            blobs[entry["sha256"]] = entry["size"]
+        total = sum(blobs.values())
+
+        for url, entry in sorted(self.index.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if url in self.in_use:
+                continue
+            del self.index[url]
+            if self._remove_blob_if_unused(entry["sha256"]):
+                total -= entry["size"]
+                self.stats["evicted"] += 1
+                logger.info(f"Evicted {url} from cache ({entry['size']} bytes)")
+
+    def _remove_blob_if_unused(self, sha256):
+        if any(entry["sha256"] == sha256 for entry in self.index.values()):
+            return False
+        path = self.blob_path(sha256)
+        if os.path.exists(path):
+            os.remove(path)
+        return True
+
+    def log_stats(self):
+        stats = self.stats
+        message = (
+            f"Cache stats: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['bytes_saved'] / 1024**2:.1f} MB saved, "
+            f"{stats['bytes_downloaded'] / 1024**2:.1f} MB downloaded, {stats['evicted']} evicted"
+        )
+        print(message)
+        logger.info(message)
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,7 +1,9 @@
-import duckdb
+import argparse
 import logging
+from profiling import StageMetrics
 
 # uses 2 functions, one to clean and one to call the cleaning on each table (necessary because of different column names for pickup and dropoff)
+# cleaning is incremental: the cleaned tables are partitioned by pickup month and only months touched by newly loaded files are rebuilt
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
@@ -9,85 +11,295 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# First function
-# Drop clean tables if exist 
-# Removes duplicates, adds duration column, and check for specified conditions 
-# Prints to log and screen
-def clean_table(con, table_name, pickup_col, dropoff_col):
-    # print initial rows
-    initial_rows = con.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-    logger.info(f"[{table_name}] Initial row count: {initial_rows}")
+# Rules a trip must not match to survive cleaning (NULLs are kept, as before)
+invalid_rules = {
+    "zero_passengers": "passenger_count = 0",
+    "zero_distance": "trip_distance = 0",
+    "over_100_miles": "trip_distance > 100",
+    "over_1_day": "trip_duration_s > 86400",
+}
 
-    clean_name = f"{table_name}_clean"
 
-    # drop old cleaned table if it exists
-    con.execute(f"DROP TABLE IF EXISTS {clean_name}")
+# State tables
+# clean_manifest: which loaded source files (and which load of them) have been cleaned
+# clean_partitions: row count and clean time of every pickup-month partition, read by the dbt models
+# clean_sources: the pickup months each cleaned source file had rows in, so a reload also rebuilds the months it left
+def create_clean_state(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS clean_manifest (
+            cab_type VARCHAR,
+            source_month DATE,
+            loaded_at TIMESTAMP,
+            cleaned_at TIMESTAMP,
+            PRIMARY KEY (cab_type, source_month)
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS clean_partitions (
+            cab_type VARCHAR,
+            pickup_month DATE,
+            row_count BIGINT,
+            cleaned_at TIMESTAMP,
+            PRIMARY KEY (cab_type, pickup_month)
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS clean_sources (
+            cab_type VARCHAR,
+            source_month DATE,
+            pickup_month DATE
+        )
+    """)
+
+
+# Column types of a table, by column name
+def table_types(con, table_name):
+    return dict(con.execute("""
+        SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ?
+    """, [table_name]).fetchall())
+
+
+# Duration type follows the raw table: INTEGER when load.py ran with --compact (UTINYINT passengers), BIGINT otherwise
+def duration_type(con, table_name):
+    return "INTEGER" if table_types(con, table_name).get("passenger_count") == "UTINYINT" else "BIGINT"
+
 
-    # remove duplicates into cleaned table
+# Cleaned table keeps a persistent fingerprint of every trip (row_hash) and its pickup month partition
+# Trip columns copy their types from the raw table, so compact types carry through from load.py
+def create_clean_table(con, table_name, clean_name, pickup_col, dropoff_col):
+    raw = table_types(con, table_name)
     con.execute(f"""
-        CREATE TABLE {clean_name} AS 
-        SELECT DISTINCT * FROM {table_name};
+        CREATE TABLE IF NOT EXISTS {clean_name} (
+            passenger_count {raw["passenger_count"]},
+            trip_distance {raw["trip_distance"]},
+            {pickup_col} TIMESTAMP,
+            {dropoff_col} TIMESTAMP,
+            trip_duration_s {duration_type(con, table_name)},
+            pickup_month DATE,
+            row_hash UBIGINT
+        )
     """)
-    row_count = con.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-    logger.info(f"[{table_name}] Row count after dropping duplicates: {row_count}")
 
-    # add duration column
-    con.execute(f"""
-        ALTER TABLE {table_name} DROP COLUMN IF EXISTS trip_duration_s;
-        ALTER TABLE {table_name} ADD COLUMN trip_duration_s BIGINT;
 
-        UPDATE {table_name}
-        SET trip_duration_s = EXTRACT(EPOCH FROM ({dropoff_col} - {pickup_col}));
-    """)
-    logger.info(f"[{table_name}] Added trip_duration_s")
+# Drops the cleaned table and its state so every month is rebuilt
+def reset_clean_table(con, table_name):
+    con.execute(f"DROP TABLE IF EXISTS {table_name}_clean")
+    con.execute("DELETE FROM clean_manifest WHERE cab_type = ?", [table_name])
+    con.execute("DELETE FROM clean_partitions WHERE cab_type = ?", [table_name])
+    con.execute("DELETE FROM clean_sources WHERE cab_type = ?", [table_name])
+
+
+# Finds the pickup months that need rebuilding
+# A source file is pending if it has been (re)loaded since it was last cleaned; its rows can land in
+# any pickup month, so the pending source months are mapped to the pickup months they contain now
+# plus the ones they contained when last cleaned (clean_sources), whose old rows have to go
+# Returns the pending files, the pickup months to rebuild and the new (source month, pickup month) pairs
+def pending_partitions(con, table_name, pickup_col):
+    pending = con.execute("""
+        SELECT m.source_month, m.loaded_at
+        FROM ingest_manifest m
+        LEFT JOIN clean_manifest c
+          ON c.cab_type = m.cab_type AND c.source_month = m.source_month
+        WHERE m.cab_type = ?
+          AND m.status = 'loaded'
+          AND c.loaded_at IS DISTINCT FROM m.loaded_at
+        ORDER BY m.source_month
+    """, [table_name]).fetchall()
+    if not pending:
+        return pending, [], []
+
+    source_months = ", ".join(f"DATE '{month}'" for month, _ in pending)
+    sources = con.execute(f"""
+        SELECT DISTINCT source_month, CAST(date_trunc('month', {pickup_col}) AS DATE) AS pickup_month
+        FROM {table_name}
+        WHERE source_month IN ({source_months})
+    """).fetchall()
+    previous = con.execute(f"""
+        SELECT DISTINCT pickup_month FROM clean_sources
+        WHERE cab_type = ? AND source_month IN ({source_months})
+    """, [table_name]).fetchall()
+    # the source months themselves too, for files cleaned before clean_sources recorded them
+    pickup_months = ({month for _, month in sources} | {month for (month,) in previous}
+                     | {month for month, _ in pending})
+    return pending, sorted(pickup_months, key=lambda month: (month is None, month)), sources
 
-    # clean invalid trips
+
+# Range filter on the raw pickup column so DuckDB can skip row groups outside the month
+def month_filter(pickup_col, month):
+    if month is None:
+        return f"{pickup_col} IS NULL"
+    return f"{pickup_col} >= DATE '{month}' AND {pickup_col} < DATE '{month}' + INTERVAL 1 MONTH"
+
+
+# Replaces one partition of the cleaned table: filters invalid trips and dedups on the
+# fingerprint, only against the other trips of the same month. Returns the rows kept
+def rebuild_partition(con, clean_name, raw_month, month, pickup_col, dropoff_col):
+    fingerprint = f"hash(passenger_count, trip_distance, {pickup_col}, {dropoff_col})"
+    any_invalid = " OR ".join(invalid_rules.values())
+    con.execute(f"DELETE FROM {clean_name} WHERE pickup_month IS NOT DISTINCT FROM ?", [month])
     con.execute(f"""
-        DELETE FROM {table_name}
-        WHERE passenger_count = 0
-           OR trip_distance = 0
-           OR trip_distance > 100
-           OR trip_duration_s > 86400;
-    """)
-    logger.info(f"[{table_name}] Removed invalid trips")
-
-    # verify
-    empty_trips = con.execute(f"SELECT COUNT(*) FROM {table_name} WHERE passenger_count = 0;").fetchone()[0]
-    zero_distance = con.execute(f"SELECT COUNT(*) FROM {table_name} WHERE trip_distance = 0;").fetchone()[0]
-    long_trips = con.execute(f"SELECT COUNT(*) FROM {table_name} WHERE trip_duration_s > 86400;").fetchone()[0]
-    far_trips = con.execute(f"SELECT COUNT(*) FROM {table_name} WHERE trip_distance > 100;").fetchone()[0]
-    row_count_f = con.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
-
-    # print to log
-    logger.info(f"[{table_name}] Trips with 0 passengers: {empty_trips}")
-    logger.info(f"[{table_name}] Trips with 0 distance: {zero_distance}")
-    logger.info(f"[{table_name}] Trips longer than 1 day: {long_trips}")
-    logger.info(f"[{table_name}] Trips over 100 miles: {far_trips}")
-    logger.info(f"[{table_name}] Final row count: {row_count_f}")
-
-    # print to screen
-    print(f"[{table_name}] Trips with 0 passengers: {empty_trips}")
-    print(f"[{table_name}] Trips with 0 distance: {zero_distance}")
-    print(f"[{table_name}] Trips longer than 1 day: {long_trips}")
-    print(f"[{table_name}] Trips over 100 miles: {far_trips}")
-    print(f"[{table_name}] Final row count: {row_count_f}")
+        INSERT INTO {clean_name}
+        SELECT DISTINCT ON (row_hash)
+            passenger_count, trip_distance, {pickup_col}, {dropoff_col}, trip_duration_s,
+            CAST(? AS DATE) AS pickup_month,
+            {fingerprint} AS row_hash
+        FROM ({raw_month})
+        WHERE ({any_invalid}) IS NOT TRUE;
+    """, [month])
+    return con.execute(
+        f"SELECT COUNT(*) FROM {clean_name} WHERE pickup_month IS NOT DISTINCT FROM ?", [month]
+    ).fetchone()[0]
+
+
+# First function
+# Rebuilds each pending pickup-month partition of {table}_clean from the raw table, one month at a time,
+# so peak memory is one month of trips rather than the whole history
+# Per month: one FILTERed profile scan, then one INSERT that adds the duration column, filters
+# invalid trips and dedups on the row fingerprint within the month
+# Verification is one scan of the rebuilt partitions with FILTERed counts
+# Returns the per-rule counts as a dict and prints them to log and screen
+def clean_table(con, table_name, pickup_col, dropoff_col, full=False):
+    clean_name = f"{table_name}_clean"
+    duration = f"TRY_CAST(EXTRACT(EPOCH FROM ({dropoff_col} - {pickup_col})) AS {duration_type(con, table_name)})"
+    any_invalid = " OR ".join(invalid_rules.values())
+    rule_counts = ", ".join(f"COUNT(*) FILTER (WHERE {rule}) AS {name}" for name, rule in invalid_rules.items())
+
+    if full:
+        reset_clean_table(con, table_name)
+    create_clean_table(con, table_name, clean_name, pickup_col, dropoff_col)
+
+    pending, months, sources = pending_partitions(con, table_name, pickup_col)
+    result = {
+        "table": table_name,
+        "partitions": len(months),
+        "initial_rows": 0,
+        "dropped": {name: 0 for name in invalid_rules},
+        "invalid_rows": 0,
+        "duplicates": 0,
+        "remaining": {name: 0 for name in invalid_rules},
+        "final_rows": 0,
+    }
+    if not months:
+        logger.info(f"[{table_name}] Up to date, nothing to clean")
+        print(f"[{table_name}] Up to date, nothing to clean")
+        return result
+    logger.info(f"[{table_name}] Rebuilding {len(months)} pickup-month partitions")
+
+    for month in months:
+        raw_month = f"""
+            SELECT *, {duration} AS trip_duration_s
+            FROM {table_name}
+            WHERE {month_filter(pickup_col, month)}
+        """
+
+        # profile the raw rows of this month: initial rows, rows matching each rule, rows matching any rule
+        profile = con.execute(f"""
+            SELECT COUNT(*) AS initial_rows, {rule_counts},
+                   COUNT(*) FILTER (WHERE {any_invalid}) AS invalid_rows
+            FROM ({raw_month});
+        """).fetchdf().iloc[0]
+
+        # replace the partition and record it, atomically
+        con.execute("BEGIN TRANSACTION")
+        try:
+            kept = rebuild_partition(con, clean_name, raw_month, month, pickup_col, dropoff_col)
+            if month is not None:
+                con.execute("""
+                    INSERT OR REPLACE INTO clean_partitions VALUES (?, ?, ?, current_localtimestamp())
+                """, [table_name, month, kept])
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+        result["initial_rows"] += int(profile["initial_rows"])
+        result["invalid_rows"] += int(profile["invalid_rows"])
+        result["duplicates"] += int(profile["initial_rows"] - profile["invalid_rows"] - kept)
+        for name in invalid_rules:
+            result["dropped"][name] += int(profile[name])
+        logger.info(f"[{table_name}] Partition {month}: {profile['initial_rows']} raw rows, {kept} kept")
+
+    # mark the pending source files as cleaned, with the pickup months they now have rows in
+    for source_month, loaded_at in pending:
+        con.execute("""
+            INSERT OR REPLACE INTO clean_manifest VALUES (?, ?, ?, current_localtimestamp())
+        """, [table_name, source_month, loaded_at])
+        con.execute("DELETE FROM clean_sources WHERE cab_type = ? AND source_month = ?", [table_name, source_month])
+    for source_month, pickup_month in sources:
+        con.execute("INSERT INTO clean_sources VALUES (?, ?, ?)", [table_name, source_month, pickup_month])
+
+    # verify the rebuilt partitions - every rule count should now be 0
+    rebuilt = []
+    dated = [f"DATE '{month}'" for month in months if month is not None]
+    if dated:
+        rebuilt.append(f"pickup_month IN ({', '.join(dated)})")
+    if None in months:
+        rebuilt.append("pickup_month IS NULL")
+    verify = con.execute(f"""
+        SELECT COUNT(*) AS final_rows, {rule_counts}
+        FROM {clean_name}
+        WHERE {" OR ".join(rebuilt)};
+    """).fetchdf().iloc[0]
+    result["remaining"] = {name: int(verify[name]) for name in invalid_rules}
+    result["final_rows"] = int(verify["final_rows"])
+
+    # print to log and screen
+    lines = [f"[{table_name}] Rebuilt partitions: {result['partitions']}"]
+    lines.append(f"[{table_name}] Initial row count: {result['initial_rows']}")
+    lines += [f"[{table_name}] Dropped ({name}): {count}" for name, count in result["dropped"].items()]
+    lines.append(f"[{table_name}] Dropped (duplicates): {result['duplicates']}")
+    lines += [f"[{table_name}] Remaining ({name}): {count}" for name, count in result["remaining"].items()]
+    lines.append(f"[{table_name}] Final row count (rebuilt partitions): {result['final_rows']}")
+    for line in lines:
+        logger.info(line)
+        print(line)
+
+    if any(result["remaining"].values()):
+        logger.error(f"[{table_name}] Verification failed: {result['remaining']}")
+
+    return result
+
+# Cleaned tables from before partitioning, or with other column types than the raw table, are rebuilt
+def check_clean_schema(con, table_name):
+    clean = table_types(con, f"{table_name}_clean")
+    raw = table_types(con, table_name)
+    if clean and ("row_hash" not in clean or clean["passenger_count"] != raw.get("passenger_count")):
+        logger.info(f"[{table_name}] Schema changed, rebuilding {table_name}_clean")
+        reset_clean_table(con, table_name)
+
 
 # Second function
 # Implements first function on tables 'yellow' and 'green' with error handling
-def clean_db(): 
+# Returns the per-table results from clean_table
+def clean_db(full=False, slow_query_ms=None):
+    results = {}
+    metrics = StageMetrics("clean", slow_ms=slow_query_ms)
     try:
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
+        con = metrics.connect(database='emissions.duckdb', read_only=False)
         logger.info("Connected to DB")
 
+        create_clean_state(con)
+        for table_name in ("yellow", "green"):
+            check_clean_schema(con, table_name)
+
         # clean yellow
-        clean_table(con, "yellow", "tpep_pickup_datetime", "tpep_dropoff_datetime")
+        results["yellow"] = clean_table(con, "yellow", "tpep_pickup_datetime", "tpep_dropoff_datetime", full)
 
         # clean green
-        clean_table(con, "green", "lpep_pickup_datetime", "lpep_dropoff_datetime")
+        results["green"] = clean_table(con, "green", "lpep_pickup_datetime", "lpep_dropoff_datetime", full)
 
+        con.close()
     except Exception as e:
+        logger.error(f"Clean failed: {e}")
         print(f"An error occurred: {e}")
+    metrics.close()
+    return results
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clean the yellow and green trip tables")
+    parser.add_argument("--full", action="store_true", help="rebuild every partition instead of only new or reloaded months")
+    parser.add_argument("--slow-query-ms", type=float, help="log the analysed plan of queries slower than this to clean_metrics.jsonl")
+    args = parser.parse_args()
 
-if __name__ == "__main__": 
-    clean_db()
+    clean_db(full=args.full, slow_query_ms=args.slow_query_ms)
@@ -0,0 +1,137 @@
+import argparse
+import duckdb
+import json
+import logging
+import os
+import shutil
+import time
+
+# Exports transformed_yellow / transformed_green to a Parquet lake that other tools can scan
+# without opening emissions.duckdb (and without contending for its file lock)
+# Layout: {lake}/cab_type=yellow/year=2024/month=3/data.parquet - hive partitions, zstd, sorted by pickup time
+# Incremental: a month is exported once dbt has transformed its latest clean, i.e. its clean_partitions.cleaned_at is
+# covered by the model's transform_watermarks row; months cleaned since the last dbt run wait for the next one
+# Everything is rewritten when the model was built with another co2 factor or other column types
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+    filename="export.log"
+)
+logger = logging.getLogger(__name__)
+
+default_lake = "lake"
+# Row groups of one DuckDB row group each; sorted by pickup so each group covers a narrow time range
+row_group_size = 122880
+
+tables = {
+    "yellow": ("transformed_yellow", "tpep_pickup_datetime", "yellow_taxi"),
+    "green": ("transformed_green", "lpep_pickup_datetime", "green_taxi"),
+}
+
+
+def read_manifest(lake):
+    try:
+        with open(os.path.join(lake, "_manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# Manifest is replaced atomically so a failed export never leaves it half written
+def write_manifest(lake, manifest):
+    tmp_path = os.path.join(lake, "_manifest.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, os.path.join(lake, "_manifest.json"))
+
+
+# Writes one month of one cab type, sorted by pickup time, to its hive partition
+# The file is written next to the partition and renamed into place so readers never see a partial file
+def export_month(con, lake, cab_type, table, pickup_col, month):
+    partition = os.path.join(lake, f"cab_type={cab_type}", f"year={month.year}", f"month={month.month}")
+    os.makedirs(partition, exist_ok=True)
+    tmp_path = os.path.join(partition, "data.parquet.tmp")
+    con.execute(f"""
+        COPY (
+            SELECT * EXCLUDE (pickup_month)
+            FROM {table}
+            WHERE pickup_month = DATE '{month}'
+            ORDER BY {pickup_col}
+        ) TO '{tmp_path}' (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE {row_group_size})
+    """)
+    os.replace(tmp_path, os.path.join(partition, "data.parquet"))
+
+
+# Exports every pickup month that dbt has rebuilt since the last export for one cab type
+def export_cab_type(con, lake, cab_type, manifest, full=False):
+    table, pickup_col, vehicle_type = tables[cab_type]
+    watermark = con.execute(
+        "SELECT cleaned_through, co2_grams_per_mile FROM transform_watermarks WHERE model_name = ?", [table]
+    ).fetchone()
+    if watermark is None:
+        logger.error(f"[{cab_type}] No transform watermark for {table}, run dbt first")
+        print(f"[{cab_type}] {table} has not been built by dbt yet, nothing exported")
+        return 0
+    cleaned_through, factor = watermark
+    columns = [list(column) for column in con.execute("""
+        SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ? ORDER BY ordinal_position
+    """, [table]).fetchall()]
+
+    state = manifest.setdefault(cab_type, {"co2_grams_per_mile": None, "columns": None, "months": {}})
+    if full or state["co2_grams_per_mile"] != factor or state.get("columns") != columns:
+        shutil.rmtree(os.path.join(lake, f"cab_type={cab_type}"), ignore_errors=True)
+        state["months"] = {}
+    state["co2_grams_per_mile"] = factor
+    state["columns"] = columns
+
+    partitions = con.execute("""
+        SELECT pickup_month, cleaned_at FROM clean_partitions WHERE cab_type = ? ORDER BY pickup_month
+    """, [cab_type]).fetchall()
+    waiting = [month for month, cleaned_at in partitions if cleaned_through is None or cleaned_at > cleaned_through]
+    pending = [
+        (month, cleaned_at) for month, cleaned_at in partitions
+        if month not in waiting and state["months"].get(str(month)) != str(cleaned_at)
+    ]
+    logger.info(f"[{cab_type}] {len(pending)} of {len(partitions)} months to export, {len(waiting)} waiting for dbt")
+    if waiting:
+        print(f"[{cab_type}] {len(waiting)} months cleaned since the last dbt run are not exported until dbt has run")
+
+    for month, cleaned_at in pending:
+        export_month(con, lake, cab_type, table, pickup_col, month)
+        state["months"][str(month)] = str(cleaned_at)
+        logger.info(f"[{cab_type}] Exported {month}")
+    print(f"[{cab_type}] Exported {len(pending)} of {len(partitions)} months")
+    return len(pending)
+
+
+# Main function - opens the database read only, exports both cab types and records what was written
+def export_lake(lake=default_lake, full=False):
+    start = time.perf_counter()
+    try:
+        con = duckdb.connect(database="emissions.duckdb", read_only=True)
+        logger.info("Connected to DuckDB")
+        os.makedirs(lake, exist_ok=True)
+        manifest = {} if full else read_manifest(lake)
+
+        for cab_type in tables:
+            export_cab_type(con, lake, cab_type, manifest, full)
+            write_manifest(lake, manifest)
+
+        con.close()
+    except Exception as e:
+        logger.error(f"Export failed: {e}")
+        print(f"An error occurred: {e}")
+        return
+
+    elapsed = time.perf_counter() - start
+    print(f"Export finished in {elapsed:.1f}s")
+    logger.info(f"Export finished in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the transformed trip tables to a hive-partitioned Parquet lake")
+    parser.add_argument("--lake", default=default_lake, help="output directory")
+    parser.add_argument("--full", action="store_true", help="rewrite every partition")
+    args = parser.parse_args()
+
+    export_lake(args.lake, args.full)
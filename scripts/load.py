@@ -1,6 +1,15 @@
-import duckdb
+import argparse
+import datetime
 import logging
-import time # sleep intervals to avoid blocks from gov server
+import os
+import pyarrow as pa
+import re
+import requests
+import threading
+import time # token bucket pacing to avoid blocks from gov server
+from concurrent.futures import ThreadPoolExecutor
+from cache import ParquetCache, default_cache_dir
+from profiling import StageMetrics
 
 
 logging.basicConfig(
@@ -10,90 +19,549 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 base_url = "https://d37ci6vzurychx.cloudfront.net/trip-data"
+years = range(2015, 2025)  # 2015–2024
 
+# Columns and types kept from each file (green uses lpep_ instead of tpep_ for pickup/dropoff)
+columns = {
+    "yellow": {
+        "passenger_count": "BIGINT",
+        "trip_distance": "DOUBLE",
+        "tpep_pickup_datetime": "TIMESTAMP",
+        "tpep_dropoff_datetime": "TIMESTAMP",
+    },
+    "green": {
+        "passenger_count": "BIGINT",
+        "trip_distance": "DOUBLE",
+        "lpep_pickup_datetime": "TIMESTAMP",
+        "lpep_dropoff_datetime": "TIMESTAMP",
+    },
+}
 
-# Loop through all years, months and append urls to lists for green and yellow data 
-yellow_urls = [
-    f"{base_url}/yellow_tripdata_{year}-{month:02d}.parquet"
-    for year in range(2015, 2025)  # 2015–2024
-    for month in range(1, 13)
-]
+# Narrower types for --compact: passenger counts fit in a byte and FLOAT keeps trip distances to well under 0.01 mile
+compact_types = {
+    "passenger_count": "UTINYINT",
+    "trip_distance": "FLOAT",
+}
 
-green_urls = [
-    f"{base_url}/green_tripdata_{year}-{month:02d}.parquet"
-    for year in range(2015, 2025)
-    for month in range(1, 13)
-]
 
-time.sleep(120)
+# Column spec for one cab type, optionally with the compact types
+def column_types(cab_type, compact=False):
+    if not compact:
+        return columns[cab_type]
+    return {col: compact_types.get(col, dtype) for col, dtype in columns[cab_type].items()}
 
-# Main function, 
-# Drops old tables if exist and extracts 4 columns from remote server
-# Places into two separate tables (yellow and green) and writes a third table from emissions csv
-def load_parquet_files():
-    con = duckdb.connect(database="emissions.duckdb", read_only=False)
-    logger.info("Connected to DuckDB instance")
 
-    # Drop old tables
-    con.execute("DROP TABLE IF EXISTS yellow")
-    con.execute("DROP TABLE IF EXISTS green")
-    con.execute("DROP TABLE IF EXISTS emissions")
+# Loop through all years, months and build the urls for one cab type
+# base can be the remote server, a local http stand-in or a file:// directory
+def build_urls(cab_type, base=base_url, year_range=years):
+    return [
+        f"{base}/{cab_type}_tripdata_{year}-{month:02d}.parquet"
+        for year in year_range
+        for month in range(1, 13)
+    ]
+
+
+yellow_urls = build_urls("yellow")
+green_urls = build_urls("green")
+
+
+# DuckDB reads local files by path, so strip the file:// scheme
+def resolve_source(url):
+    if url.startswith("file://"):
+        return url[len("file://"):]
+    return url
+
+
+# Token bucket - replaces the fixed sleeps between files
+# Allows short bursts of `capacity` requests, then paces to `rate` requests per second (0 = unlimited)
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 
-    # Create yellow table schema from first file
-    con.execute(f"""
-        CREATE TABLE yellow AS
-        SELECT passenger_count, trip_distance, tpep_pickup_datetime, tpep_dropoff_datetime
-        FROM read_parquet('{yellow_urls[0]}')
+# Month a source file covers, parsed from its name (e.g. yellow_tripdata_2019-03.parquet -> 2019-03-01)
+def source_month(url):
+    match = re.search(r"_(\d{4})-(\d{2})\.parquet$", url)
+    return datetime.date(int(match.group(1)), int(match.group(2)), 1)
+
+
+# Cheap change detection without downloading: size/mtime for local files, size/ETag from a HEAD request otherwise
+def probe_source(url):
+    source = resolve_source(url)
+    if "://" not in source:
+        stat = os.stat(source)
+        return {
+            "size_bytes": stat.st_size,
+            "etag": None,
+            "mtime": datetime.datetime.fromtimestamp(stat.st_mtime),
+        }
+    response = requests.head(source, timeout=30, allow_redirects=True)
+    response.raise_for_status()
+    return {
+        "size_bytes": int(response.headers.get("Content-Length", 0)) or None,
+        "etag": response.headers.get("ETag"),
+        "mtime": None,
+    }
+
+
+# Probe that logs and returns None instead of raising (e.g. a month not published yet)
+def _safe_probe(url):
+    try:
+        return probe_source(url)
+    except Exception as e:
+        logger.warning(f"Probe failed for {url}: {e}")
+        return None
+
+
+# Persistent record of every source file: what was loaded, when, and whether it worked
+def create_manifest(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_manifest (
+            cab_type VARCHAR,
+            source_month DATE,
+            source_url VARCHAR,
+            size_bytes BIGINT,
+            etag VARCHAR,
+            mtime TIMESTAMP,
+            row_count BIGINT,
+            loaded_at TIMESTAMP,
+            status VARCHAR,
+            error VARCHAR,
+            PRIMARY KEY (cab_type, source_month)
+        )
     """)
-    logger.info(f"Created yellow table from {yellow_urls[0]}")
 
-    time.sleep(20)
-    # Insert rest
-    for url in yellow_urls[1:]:
+
+def record_manifest(con, cab_type, url, probe, row_count, status, error=None):
+    con.execute("""
+        INSERT OR REPLACE INTO ingest_manifest
+        VALUES (?, ?, ?, ?, ?, ?, ?, current_localtimestamp(), ?, ?)
+    """, [
+        cab_type, source_month(url), url,
+        probe.get("size_bytes"), probe.get("etag"), probe.get("mtime"),
+        row_count, status, error,
+    ])
+
+
+# Probes every url in parallel (None for urls that could not be probed)
+def probe_sources(urls, workers):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_safe_probe, urls))
+
+
+# Decides which months need loading by comparing probes against the manifest
+# Default: new, changed and previously failed months. retry_failed: only previously failed months
+# probes can be passed in when the caller has already probed the urls
+# A month that can't be probed (e.g. not published yet) is recorded as failed rather than dropped
+def plan_months(con, cab_type, urls, workers, retry_failed=False, probes=None):
+    manifest = {
+        row[0]: row[1:]
+        for row in con.execute("""
+            SELECT source_month, size_bytes, etag, mtime, status
+            FROM ingest_manifest
+            WHERE cab_type = ?
+        """, [cab_type]).fetchall()
+    }
+
+    if probes is None:
+        probes = probe_sources(urls, workers)
+
+    planned, unprobed = [], 0
+    for url, probe in zip(urls, probes):
+        previous = manifest.get(source_month(url))
+        if probe is None:
+            # recorded as failed (not dropped), so the summary counts it and --retry-failed tries it again
+            logger.warning(f"Could not probe {url}, recorded as failed")
+            record_manifest(con, cab_type, url, {}, None, "failed", "probe failed")
+            unprobed += 1
+            continue
+        if previous is None:
+            reason = "new"
+        elif previous[3] != "loaded":
+            reason = "failed"
+        elif (previous[0], previous[1], previous[2]) != (probe["size_bytes"], probe["etag"], probe["mtime"]):
+            reason = "changed"
+        else:
+            continue
+        if retry_failed and reason != "failed":
+            continue
+        planned.append((url, probe, reason))
+        logger.info(f"Planned {url} ({reason})")
+
+    not_found = f", {unprobed} could not be probed (failed)" if unprobed else ""
+    print(f"{cab_type.capitalize()}: {len(planned)} of {len(urls)} months to load{not_found}")
+    logger.info(f"{cab_type}: {len(planned)} of {len(urls)} months to load{not_found}")
+    return planned
+
+
+# Local path to read a month from
+# Remote files go through the parquet cache (the limiter is only hit on a cache miss), local files are read in place
+def local_source(url, probe, limiter, cache):
+    source = resolve_source(url)
+    if "://" not in source:
+        return source
+    if cache is None:
+        limiter.acquire()
+        return source
+    return cache.resolve(source, probe, limiter)
+
+
+# Older names of a column (2009 yellow files use Trip_Pickup_DateTime, 2010-2014 ones pickup_datetime)
+# Names are matched case-insensitively, as union_by_name does
+column_aliases = {
+    "tpep_pickup_datetime": ["pickup_datetime", "trip_pickup_datetime"],
+    "tpep_dropoff_datetime": ["dropoff_datetime", "trip_dropoff_datetime"],
+}
+
+
+# Local paths of the planned months, fetched in parallel (remote files through the cache, pinned until released)
+# Returns {url: path or the exception that stopped it}
+def fetch_sources(planned, workers, limiter, cache):
+    def fetch(url, probe):
         try:
-            con.execute(f"""
-                INSERT INTO yellow
-                SELECT passenger_count, trip_distance, tpep_pickup_datetime, tpep_dropoff_datetime
-                FROM read_parquet('{url}')
-            """)
-            # Row count after each insert
-            count = con.execute("SELECT COUNT(*) FROM yellow").fetchone()[0]
-            print(f"Yellow row count after {url}: {count}")
-            time.sleep(40)
+            return local_source(url, probe, limiter, cache)
         except Exception as e:
-            logger.warning(f"Skipping {url} due to error: {e}")
+            return e
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip([url for url, _, _ in planned], pool.map(lambda month: fetch(*month[:2]), planned)))
+
+
+# Lets the cache evict a remote month again once it has been read
+def release_source(url, cache):
+    if cache is not None and "://" in resolve_source(url):
+        cache.release(url)
+
+
+# Reads only the Parquet footers of the files: column names, types and row counts
+# All files are read in one query; if that fails each file is read alone, so one bad file can't hide the others
+# Returns ({source: {"columns": {lower-case name: (name, type)}, "rows": n}}, {source: error})
+def read_footers(con, sources):
+    try:
+        schema_rows = con.execute("""
+            SELECT file_name, name, duckdb_type FROM parquet_schema(?) WHERE duckdb_type IS NOT NULL
+        """, [sources]).fetchall()
+        row_counts = con.execute("""
+            SELECT file_name, SUM(num_rows) FROM parquet_file_metadata(?) GROUP BY file_name
+        """, [sources]).fetchall()
+    except Exception:
+        if len(sources) == 1:
+            raise
+        footers, errors = {}, {}
+        for source in sources:
+            try:
+                footers.update(read_footers(con, [source])[0])
+            except Exception as e:
+                errors[source] = str(e)
+        return footers, errors
+
+    footers = {file_name: {"columns": {}, "rows": rows} for file_name, rows in row_counts}
+    for file_name, name, dtype in schema_rows:
+        footers[file_name]["columns"][name.lower()] = (name, dtype)
+    return footers, {}
+
+
+# Months as YYYY-MM, shortened to first..last for long lists
+def month_span(months):
+    labels = sorted(month.strftime("%Y-%m") for month in months)
+    return ", ".join(labels) if len(labels) <= 6 else f"{labels[0]}..{labels[-1]}"
 
-    # Emissions table
+
+# Prints every column whose name or type differs between months (most common variant first)
+def report_drift(cab_type, variants):
+    for col, found in variants.items():
+        ranked = sorted(found.items(), key=lambda item: len(item[1]), reverse=True)
+        if len(ranked) < 2 and all(name == col for name, _ in found):
+            continue
+        described = ", ".join(
+            f"{name + ' ' if name != col else ''}{dtype} in {len(months)} month{'s' if len(months) > 1 else ''}"
+            + (f" ({month_span(months)})" if position else "")
+            for position, ((name, dtype), months) in enumerate(ranked)
+        )
+        print(f"{cab_type.capitalize()} schema drift in {col}: {described}")
+        logger.info(f"{cab_type} schema drift in {col}: {described}")
+
+
+# Schema plan for the planned months of one cab type, built from their footers alone (no row data is decoded)
+# Finds each column of the table spec in every file by name or alias and reports name/type drift across months
+# Returns the loadable months as (url, probe, rows, {column: name in the file}, path) and the others as
+# (url, probe, reason), so a month that can't be fetched, read or lacks a column is recorded instead of dropped
+def plan_schema(con, cab_type, schema, planned, workers, limiter, cache):
+    sources = fetch_sources(planned, workers, limiter, cache)
+    paths = [source for source in sources.values() if isinstance(source, str)]
+    footers, errors = read_footers(con, paths) if paths else ({}, {})
+
+    variants = {col: {} for col in schema}
+    usable, failed = [], []
+    for url, probe, _ in planned:
+        source = sources[url]
+        footer = footers.get(source) if isinstance(source, str) else None
+        if footer is None:
+            reason = f"fetch failed: {source}" if isinstance(source, Exception) else f"unreadable footer: {errors.get(source)}"
+            failed.append((url, probe, reason))
+            release_source(url, cache)
+            continue
+        found = {}
+        for col in schema:
+            name = next((name for name in [col, *column_aliases.get(col, [])] if name in footer["columns"]), None)
+            if name is not None:
+                found[col] = footer["columns"][name]
+        missing = [col for col in schema if col not in found]
+        if missing:
+            failed.append((url, probe, f"missing column {', '.join(missing)}"))
+            release_source(url, cache)
+            continue
+        for col, variant in found.items():
+            variants[col].setdefault(variant, []).append(source_month(url))
+        usable.append((url, probe, footer["rows"], {col: name for col, (name, _) in found.items()}, source))
+
+    report_drift(cab_type, variants)
+    return usable, failed
+
+
+# Unified projection for a set of months: each column is the COALESCE of the names it has in those files
+# (union_by_name gives every distinct name its own column), cast explicitly to the table type
+# TRY_CAST for the compact types, so an out-of-range value becomes NULL instead of failing the months
+def select_list(schema, months):
+    expressions = []
+    for col, dtype in schema.items():
+        names = sorted({found[col].lower() for _, _, _, found, _ in months}, key=lambda name: name != col)
+        value = names[0] if len(names) == 1 else f"COALESCE({', '.join(names)})"
+        expressions.append(f"{'TRY_CAST' if dtype in compact_types.values() else 'CAST'}({value} AS {dtype}) AS {col}")
+    return ", ".join(expressions)
+
+
+# Bulk load of a set of months with one multi-file read_parquet (union_by_name, decoded in parallel by DuckDB)
+# and one INSERT; each row gets its month through the file it came from
+# Rows from earlier loads of the same months are replaced, and the manifest is updated in the same transaction
+def insert_months(con, cab_type, schema, months):
+    month_files = pa.table({
+        "filename": [path for _, _, _, _, path in months],
+        "source_month": [source_month(url) for url, _, _, _, _ in months],
+    })
+    con.register("month_files", month_files)
+    try:
+        con.execute("BEGIN TRANSACTION")
+        for url, _, _, _, _ in months:
+            con.execute(f"DELETE FROM {cab_type} WHERE source_month = ?", [source_month(url)])
+        # a file shared by two months (identical content in the cache) is scanned once and joined to both
+        con.execute(f"""
+            INSERT INTO {cab_type}
+            SELECT {select_list(schema, months)}, month_files.source_month
+            FROM read_parquet(?, union_by_name = true, filename = true) AS trips
+            JOIN month_files ON trips.filename = month_files.filename
+        """, [list(dict.fromkeys(month_files["filename"].to_pylist()))])
+        for url, probe, rows, _, _ in months:
+            record_manifest(con, cab_type, url, probe, rows, "loaded")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.unregister("month_files")
+    return sum(rows for _, _, rows, _, _ in months)
+
+
+# Loads a set of months in one bulk scan; if that fails, each month is loaded on its own to isolate the bad file
+# Returns the number of rows loaded
+def load_months(con, cab_type, schema, months):
+    try:
+        total = insert_months(con, cab_type, schema, months)
+    except Exception as e:
+        if len(months) > 1:
+            logger.warning(f"Bulk scan of {len(months)} {cab_type} months failed, loading them one by one: {e}")
+            return sum(load_months(con, cab_type, schema, [month]) for month in months)
+        url, probe = months[0][:2]
+        print(f"Failed to load {url}: {e}")
+        logger.warning(f"Failed to load {url}: {e}")
+        record_manifest(con, cab_type, url, probe, None, "failed", str(e))
+        return 0
+
+    for url, _, rows, _, _ in months:
+        print(f"{cab_type.capitalize()} rows in {url}: {rows}")
+        logger.info(f"Loaded {rows} rows from {url}")
+    logger.info(f"Inserted {len(months)} months into {cab_type} with one scan")
+    return total
+
+
+# Creates an empty trip table from the column spec
+# source_month ties every row back to its file so a changed month can be replaced
+def create_trip_table(con, cab_type, schema):
+    column_list = ", ".join(f"{col} {dtype}" for col, dtype in schema.items())
+    con.execute(f"CREATE TABLE IF NOT EXISTS {cab_type} ({column_list}, source_month DATE)")
+
+
+# Type of passenger_count in an existing trip table (None if the table doesn't exist yet)
+def existing_passenger_type(con, cab_type):
+    row = con.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = ? AND column_name = 'passenger_count'
+    """, [cab_type]).fetchone()
+    return row[0] if row else None
+
+
+# Splits the planned months into bulk scans of batch_size months (0 = all of them)
+# With the parquet cache a scan also holds no more remote bytes than the cache may keep: its files stay pinned
+# until the scan is inserted, so a bigger scan would push the cache past --cache-max-gb (a single month always fits)
+def scan_groups(planned, batch_size, cache):
+    groups, group, group_bytes = [], [], 0
+    for month in planned:
+        url, probe, _ = month
+        size = (probe.get("size_bytes") or 0) if cache is not None and "://" in resolve_source(url) else 0
+        if group and ((batch_size > 0 and len(group) >= batch_size)
+                      or (cache is not None and group_bytes + size > cache.max_bytes)):
+            groups.append(group)
+            group, group_bytes = [], 0
+        group.append(month)
+        group_bytes += size
+    if group:
+        groups.append(group)
+    return groups
+
+
+# Loads the planned months for one cab type, one scan group at a time
+# Each group is fetched and planned from its footers first, then every loadable month of it is loaded with one
+# bulk scan and its files are released to the cache before the next group is fetched
+def load_cab_type(con, cab_type, schema, planned, workers, batch_size, limiter, cache):
+    total = 0
+    groups = scan_groups(planned, batch_size, cache)
+    if len(groups) > 1:
+        logger.info(f"{cab_type}: {len(planned)} months split into {len(groups)} scans")
+    for group in groups:
+        usable, failed = plan_schema(con, cab_type, schema, group, workers, limiter, cache)
+        for url, probe, reason in failed:
+            print(f"Not loading {url}: {reason}")
+            logger.warning(f"Not loading {url}: {reason}")
+            record_manifest(con, cab_type, url, probe, None, "failed", reason)
+        try:
+            if usable:
+                total += load_months(con, cab_type, schema, usable)
+        finally:
+            for url, _, _, _, _ in usable:
+                release_source(url, cache)
+
+    print(f"{cab_type.capitalize()} total rows loaded: {total}")
+    logger.info(f"{cab_type} total rows loaded: {total}")
+    return total
+
+
+# Creates the manifest and trip tables, dropping them first when everything has to be reloaded
+# Returns True if existing trip tables were dropped
+def prepare_tables(con, compact=False, full_refresh=False):
+    # Trip tables from before the manifest existed can't be matched to files, so start over
+    has_manifest = con.execute("""
+        SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'ingest_manifest'
+    """).fetchone()[0]
+    # Switching between default and compact types needs a reload too
+    schema_changed = any(
+        existing_passenger_type(con, cab_type) not in (None, column_types(cab_type, compact)["passenger_count"])
+        for cab_type in ("yellow", "green")
+    )
+    reset = full_refresh or not has_manifest or schema_changed
+    if reset:
+        logger.info("Full refresh: dropping trip tables and manifest")
+        con.execute("DROP TABLE IF EXISTS yellow")
+        con.execute("DROP TABLE IF EXISTS green")
+        con.execute("DROP TABLE IF EXISTS ingest_manifest")
+        # frees the dropped tables' blocks now, so the reload reuses them instead of growing the file
+        con.execute("CHECKPOINT")
+
+    create_manifest(con)
+    # Explicit schemas instead of copying the first file, so every month lands in the same types
+    for cab_type in ("yellow", "green"):
+        create_trip_table(con, cab_type, column_types(cab_type, compact))
+    return reset
+
+
+# Emissions table (small, so always rebuilt from the csv)
+def load_emissions(con):
     con.execute("""
-        CREATE TABLE emissions AS
+        CREATE OR REPLACE TABLE emissions AS
         SELECT * FROM read_csv('data/vehicle_emissions.csv')
     """)
     print("Emissions row count:", con.execute("SELECT COUNT(*) FROM emissions").fetchone()[0])
 
 
-    time.sleep(180)
-    # Same pattern for green
-    con.execute(f"""
-        CREATE TABLE green AS
-        SELECT passenger_count, trip_distance, lpep_pickup_datetime, lpep_dropoff_datetime
-        FROM read_parquet('{green_urls[0]}')
-    """)
-    logger.info(f"Created green table from {green_urls[0]}")
-    time.sleep(20)
-    for url in green_urls[1:]:
-        try:
-            con.execute(f"""
-                INSERT INTO green
-                SELECT passenger_count, trip_distance, lpep_pickup_datetime, lpep_dropoff_datetime
-                FROM read_parquet('{url}')
-            """)
-            count = con.execute("SELECT COUNT(*) FROM green").fetchone()[0]
-            print(f"Green row count after {url}: {count}")
-            time.sleep(40)
-        except Exception as e:
-            logger.warning(f"Skipping {url} due to error: {e}")
+# Main function,
+# Loads only new, changed or previously failed months (full_refresh drops everything and reloads)
+# Places into two separate tables (yellow and green) and writes a third table from emissions csv
+def load_parquet_files(base=base_url, year_range=years, workers=4, batch_size=0, rate=0.5,
+                       full_refresh=False, retry_failed=False, cache=None, compact=False, slow_query_ms=None):
+    metrics = StageMetrics("load", slow_ms=slow_query_ms)
+    con = metrics.connect(database="emissions.duckdb", read_only=False)
+    logger.info("Connected to DuckDB instance")
+    limiter = TokenBucket(rate, capacity=workers)
+    start = time.perf_counter()
+
+    prepare_tables(con, compact, full_refresh)
+    load_emissions(con)
+
+    for cab_type in ("yellow", "green"):
+        planned = plan_months(con, cab_type, build_urls(cab_type, base, year_range), workers, retry_failed)
+        load_cab_type(con, cab_type, column_types(cab_type, compact), planned, workers, batch_size, limiter, cache)
 
+    failed = con.execute("SELECT COUNT(*) FROM ingest_manifest WHERE status = 'failed'").fetchone()[0]
+    if failed:
+        print(f"{failed} months failed to load, rerun with --retry-failed")
+        logger.warning(f"{failed} months failed to load")
+
+    if cache is not None:
+        cache.log_stats()
+
+    elapsed = time.perf_counter() - start
+    print(f"Load finished in {elapsed:.1f}s")
+    logger.info(f"Load finished in {elapsed:.1f}s")
+    con.close()
+    metrics.close()
 
 
 if __name__ == "__main__":
-    load_parquet_files()
+    parser = argparse.ArgumentParser(description="Load NYC taxi trip data into emissions.duckdb")
+    parser.add_argument("--base-url", default=base_url, help="remote server, local http stand-in or file:// directory")
+    parser.add_argument("--start-year", type=int, default=years.start)
+    parser.add_argument("--end-year", type=int, default=years.stop - 1)
+    parser.add_argument("--workers", type=int, default=4, help="months fetched in parallel")
+    parser.add_argument("--batch-size", type=int, default=0, help="months per bulk scan (0 = all months of a cab type in one scan, as far as --cache-max-gb allows)")
+    parser.add_argument("--rate", type=float, default=0.5, help="max file requests per second (0 = unlimited)")
+    parser.add_argument("--full-refresh", action="store_true", help="drop all trip tables and reload every month")
+    parser.add_argument("--retry-failed", action="store_true", help="only retry months that failed previously")
+    parser.add_argument("--cache-dir", default=default_cache_dir, help="local parquet cache for remote files")
+    parser.add_argument("--cache-max-gb", type=float, default=50, help="cache size cap, least recently used files are evicted")
+    parser.add_argument("--no-cache", action="store_true", help="read remote files directly instead of through the cache")
+    parser.add_argument("--compact", action="store_true", help="store passenger_count as UTINYINT and trip_distance as FLOAT")
+    parser.add_argument("--slow-query-ms", type=float, help="log the analysed plan of queries slower than this to load_metrics.jsonl")
+    args = parser.parse_args()
+
+    cache = None
+    if not args.no_cache:
+        cache = ParquetCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024**3))
+
+    load_parquet_files(
+        base=args.base_url.rstrip("/"),
+        year_range=range(args.start_year, args.end_year + 1),
+        workers=args.workers,
+        batch_size=args.batch_size,
+        rate=args.rate,
+        full_refresh=args.full_refresh,
+        retry_failed=args.retry_failed,
+        cache=cache,
+        compact=args.compact,
+        slow_query_ms=args.slow_query_ms,
+    )
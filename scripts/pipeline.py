@@ -0,0 +1,332 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from cache import ParquetCache, default_cache_dir
+from clean import check_clean_schema, clean_table, create_clean_state
+from load import (TokenBucket, base_url, build_urls, column_types, load_cab_type, load_emissions, plan_months,
+                  prepare_tables, probe_sources, years)
+from profiling import StageMetrics
+
+# Single entry point for load -> clean -> dbt -> analysis
+# Stages form a DAG with separate yellow and green branches; independent stages run concurrently on their own cursors
+# Every stage fingerprints its inputs (source file probes, vehicle_emissions.csv, script and model SQL, versions of
+# the upstream tables) and is skipped when the fingerprint matches its last successful run (pipeline_state table)
+# Stages that run in another process (dbt, analysis) get the database to themselves while they run
+
+# The stage modules configure logging on import; route each module's log back to its own file
+logging.getLogger().handlers.clear()
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+    filename="pipeline.log"
+)
+logger = logging.getLogger(__name__)
+for module, log_file in {"load": "load.log", "cache": "load.log", "clean": "clean.log"}.items():
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logging.getLogger(module).addHandler(handler)
+    logging.getLogger(module).propagate = False
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+dbt_dir = os.path.join(os.path.dirname(scripts_dir), "dbt")
+dbt_target_dir = os.path.abspath(os.path.join(".cache", "dbt", "target"))
+dbt_log_dir = os.path.abspath(os.path.join(".cache", "dbt", "logs"))
+
+# Pickup and dropoff columns of each branch
+branches = {
+    "yellow": ("tpep_pickup_datetime", "tpep_dropoff_datetime"),
+    "green": ("lpep_pickup_datetime", "lpep_dropoff_datetime"),
+}
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(*paths):
+    sha = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+# Version of an upstream table: a digest of the rows of its state query (empty if the table doesn't exist yet)
+def table_version(con, query, parameters=None):
+    try:
+        return digest(con.execute(query, parameters).fetchall())
+    except Exception:
+        return None
+
+
+# Last successful fingerprint of every stage (and of every dbt model)
+def create_pipeline_state(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_state (
+            stage VARCHAR PRIMARY KEY,
+            fingerprint VARCHAR,
+            seconds DOUBLE,
+            finished_at TIMESTAMP
+        )
+    """)
+
+
+def saved_fingerprints(con):
+    return dict(con.execute("SELECT stage, fingerprint FROM pipeline_state").fetchall())
+
+
+def save_fingerprints(con, parts, seconds):
+    for part, fingerprint in parts.items():
+        con.execute("""
+            INSERT OR REPLACE INTO pipeline_state VALUES (?, ?, ?, current_localtimestamp())
+        """, [part, fingerprint, seconds])
+
+
+# A node of the DAG
+# fingerprint(con) returns {part: fingerprint}; most stages have one part (the stage itself), the dbt stage has
+# one per model so only changed models are selected. run(con, changed_parts) does the work
+# external stages run in another process, so the pipeline's connection is closed while they run
+class Stage:
+    def __init__(self, name, deps, fingerprint, run, external=False):
+        self.name = name
+        self.deps = deps
+        self.fingerprint = fingerprint
+        self.run = run
+        self.external = external
+
+
+# Runs the DAG. Returns {stage: "ran" | "skipped" | "failed" | "blocked"}
+class Pipeline:
+    def __init__(self, stages, metrics, database="emissions.duckdb", force=False, workers=2):
+        self.stages = {stage.name: stage for stage in stages}
+        self.metrics = metrics
+        self.database = database
+        self.force = force
+        self.workers = workers
+        self.con = None
+
+    def connect(self):
+        self.con = self.metrics.connect(database=self.database, read_only=False)
+        create_pipeline_state(self.con)
+
+    # Fingerprints a stage and runs it if anything changed; runs on its own cursor
+    def run_stage(self, stage):
+        cursor = self.con.cursor()
+        try:
+            parts = stage.fingerprint(cursor)
+            saved = saved_fingerprints(cursor)
+            changed = [part for part, fingerprint in parts.items() if self.force or saved.get(part) != fingerprint]
+            if not changed:
+                logger.info(f"{stage.name}: up to date, skipped")
+                print(f"{stage.name:<16} up to date")
+                return "skipped"
+
+            logger.info(f"{stage.name}: running ({', '.join(changed)} changed)")
+            start = time.perf_counter()
+            if stage.external:
+                cursor.close()
+                self.con.close()
+                try:
+                    stage.run(None, changed)
+                finally:
+                    self.connect()
+                    cursor = self.con.cursor()
+            else:
+                stage.run(cursor, changed)
+            elapsed = time.perf_counter() - start
+            save_fingerprints(cursor, {part: parts[part] for part in changed}, elapsed)
+            logger.info(f"{stage.name}: finished in {elapsed:.1f}s")
+            print(f"{stage.name:<16} ran in {elapsed:.1f}s")
+            return "ran"
+        finally:
+            cursor.close()
+
+    def run(self):
+        self.connect()
+        status = {}
+        pending = dict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if any(status.get(dep) in ("failed", "blocked") for dep in stage.deps):
+                        status[name] = "blocked"
+                        del pending[name]
+                        logger.warning(f"{name}: blocked by a failed upstream stage")
+                    elif all(status.get(dep) in ("ran", "skipped") for dep in stage.deps):
+                        # external stages need the database to themselves
+                        if stage.external and running:
+                            continue
+                        if any(self.stages[other].external for other in running.values()):
+                            continue
+                        running[pool.submit(self.run_stage, stage)] = name
+                        del pending[name]
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except Exception as e:
+                        status[name] = "failed"
+                        logger.error(f"{name} failed: {e}")
+                        print(f"{name:<16} FAILED: {e}")
+        self.con.close()
+        return status
+
+
+# Stages of the pipeline
+def build_stages(args, limiter, cache):
+    load_script = os.path.join(scripts_dir, "load.py")
+    clean_script = os.path.join(scripts_dir, "clean.py")
+    analysis_script = os.path.join(scripts_dir, "analysis.py")
+    emissions_csv = os.path.join("data", "vehicle_emissions.csv")
+    year_range = range(args.start_year, args.end_year + 1)
+    models = {os.path.splitext(os.path.basename(path))[0]: path
+              for path in sorted(glob.glob(os.path.join(dbt_dir, "models", "*.sql")))}
+    dbt_code = file_digest(os.path.join(dbt_dir, "dbt_project.yml"),
+                           *sorted(glob.glob(os.path.join(dbt_dir, "macros", "*.sql"))))
+    probes = {}
+
+    def emissions_fingerprint(con):
+        return {"emissions": digest([file_digest(load_script), file_digest(emissions_csv)])}
+
+    def run_emissions(con, changed):
+        load_emissions(con)
+
+    def load_fingerprint(cab_type):
+        def fingerprint(con):
+            urls = build_urls(cab_type, args.base_url, year_range)
+            probes[cab_type] = probe_sources(urls, args.workers)
+            # months that failed last time keep the stage dirty until they load
+            failed = con.execute("""
+                SELECT COUNT(*) FROM ingest_manifest WHERE cab_type = ? AND status = 'failed'
+            """, [cab_type]).fetchone()[0]
+            return {f"load_{cab_type}": digest([file_digest(load_script), args.compact, urls, probes[cab_type], failed])}
+        return fingerprint
+
+    def run_load(cab_type):
+        def run(con, changed):
+            urls = build_urls(cab_type, args.base_url, year_range)
+            planned = plan_months(con, cab_type, urls, args.workers, probes=probes[cab_type])
+            schema = column_types(cab_type, args.compact)
+            load_cab_type(con, cab_type, schema, planned, args.workers, args.batch_size, limiter, cache)
+        return run
+
+    def clean_fingerprint(cab_type):
+        def fingerprint(con):
+            loaded = table_version(con, """
+                SELECT source_month, loaded_at FROM ingest_manifest
+                WHERE cab_type = ? AND status = 'loaded' ORDER BY source_month
+            """, [cab_type])
+            return {f"clean_{cab_type}": digest([file_digest(clean_script), loaded])}
+        return fingerprint
+
+    def run_clean(cab_type):
+        def run(con, changed):
+            check_clean_schema(con, cab_type)
+            clean_table(con, cab_type, *branches[cab_type], full=args.full_refresh)
+        return run
+
+    # One part per dbt model: its SQL, the shared macros and project config, and its upstream versions
+    def transform_fingerprint(con):
+        emissions = file_digest(emissions_csv)
+        parts = {}
+        for cab_type in branches:
+            cleaned = table_version(con, """
+                SELECT pickup_month, cleaned_at FROM clean_partitions WHERE cab_type = ? ORDER BY pickup_month
+            """, [cab_type])
+            model = f"transformed_{cab_type}"
+            parts[f"dbt:{model}"] = digest([file_digest(models[model]), dbt_code, args.compact, emissions, cleaned])
+        for model, path in models.items():
+            if f"dbt:{model}" not in parts:
+                upstream = [parts[part] for part in sorted(parts)]
+                parts[f"dbt:{model}"] = digest([file_digest(path), dbt_code, args.compact, upstream])
+        return parts
+
+    # dbt runs the selected models with its own threads, so the yellow and green models still build concurrently
+    # Its compiled SQL and logs go under the working directory's .cache, never into the repo's dbt project
+    def run_transform(con, changed):
+        command = ["dbt", "run", "--project-dir", dbt_dir, "--profiles-dir", dbt_dir,
+                   "--target-path", dbt_target_dir, "--log-path", dbt_log_dir,
+                   "--select", *(part.split(":", 1)[1] for part in changed)]
+        if args.full_refresh:
+            command.append("--full-refresh")
+        if args.compact:
+            command += ["--vars", "{compact: true}"]
+        subprocess.run(command, check=True)
+
+    def analysis_fingerprint(con):
+        transformed = table_version(con, "SELECT * FROM transform_watermarks ORDER BY model_name")
+        return {"analysis": digest([file_digest(analysis_script), args.analysis_mode, transformed])}
+
+    def run_analysis(con, changed):
+        subprocess.run([sys.executable, analysis_script, "--mode", args.analysis_mode], check=True)
+
+    stages = [Stage("emissions", [], emissions_fingerprint, run_emissions)]
+    for cab_type in branches:
+        stages.append(Stage(f"load_{cab_type}", [], load_fingerprint(cab_type), run_load(cab_type)))
+        stages.append(Stage(f"clean_{cab_type}", [f"load_{cab_type}"], clean_fingerprint(cab_type), run_clean(cab_type)))
+    stages.append(Stage("transform", ["emissions", "clean_yellow", "clean_green"], transform_fingerprint, run_transform,
+                        external=True))
+    stages.append(Stage("analysis", ["transform"], analysis_fingerprint, run_analysis, external=True))
+    return stages
+
+
+# Main function - prepares the tables, then runs every stage whose inputs changed
+def run_pipeline(args):
+    start = time.perf_counter()
+    metrics = StageMetrics("pipeline", slow_ms=args.slow_query_ms)
+    con = metrics.connect(database="emissions.duckdb", read_only=False)
+    # a reset (first run, --full-refresh, switch to or from --compact) reloads everything downstream too
+    if prepare_tables(con, args.compact, args.full_refresh):
+        args.full_refresh = True
+    create_clean_state(con)
+    con.close()
+
+    cache = None
+    if not args.no_cache:
+        cache = ParquetCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024**3))
+    limiter = TokenBucket(args.rate, capacity=args.workers)
+
+    pipeline = Pipeline(build_stages(args, limiter, cache), metrics, force=args.full_refresh, workers=args.branches)
+    status = pipeline.run()
+    if cache is not None:
+        cache.log_stats()
+    metrics.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Pipeline finished in {elapsed:.1f}s: " + ", ".join(f"{name} {state}" for name, state in status.items()))
+    logger.info(f"Pipeline finished in {elapsed:.1f}s: {status}")
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run load, clean, dbt and analysis, skipping stages whose inputs are unchanged")
+    parser.add_argument("--base-url", default=base_url, help="remote server, local http stand-in or file:// directory")
+    parser.add_argument("--start-year", type=int, default=years.start)
+    parser.add_argument("--end-year", type=int, default=years.stop - 1)
+    parser.add_argument("--workers", type=int, default=4, help="months fetched in parallel per branch")
+    parser.add_argument("--batch-size", type=int, default=0, help="months per bulk scan (0 = all months of a cab type in one scan, as far as --cache-max-gb allows)")
+    parser.add_argument("--rate", type=float, default=0.5, help="max file requests per second, shared by both branches (0 = unlimited)")
+    parser.add_argument("--branches", type=int, default=2, help="stages run concurrently (yellow and green branches)")
+    parser.add_argument("--full-refresh", action="store_true", help="rerun every stage from scratch")
+    parser.add_argument("--compact", action="store_true", help="compact column types in load and dbt")
+    parser.add_argument("--analysis-mode", choices=["rollup", "trips", "single-pass"], default="rollup")
+    parser.add_argument("--cache-dir", default=default_cache_dir, help="local parquet cache for remote files")
+    parser.add_argument("--cache-max-gb", type=float, default=50, help="cache size cap, least recently used files are evicted")
+    parser.add_argument("--no-cache", action="store_true", help="read remote files directly instead of through the cache")
+    parser.add_argument("--slow-query-ms", type=float, help="log the analysed plan of queries slower than this to pipeline_metrics.jsonl")
+    args = parser.parse_args()
+    args.base_url = args.base_url.rstrip("/")
+
+    status = run_pipeline(args)
+    if "failed" in status.values():
+        sys.exit(1)
@@ -0,0 +1,180 @@
+import datetime
+import duckdb
+import functools
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+
+# Per-query metrics for load.py, clean.py and analysis.py
+# StageMetrics.connect() returns a DuckDB connection whose execute() is timed and profiled; every query is
+# written as one JSON line to {stage}_metrics.jsonl (next to {stage}.log), followed by a stage summary line
+# Rows returned, rows scanned, CPU time and peak buffer memory come from DuckDB's own JSON profile of the query
+# Queries slower than slow_ms also get their analysed plan (the EXPLAIN ANALYZE tree, without running them twice)
+
+logger = logging.getLogger(__name__)
+
+# Fields kept from DuckDB's JSON profile
+profile_fields = {
+    "latency": "duckdb_s",
+    "cpu_time": "cpu_s",
+    "rows_returned": "rows_returned",
+    "cumulative_rows_scanned": "rows_scanned",
+    "system_peak_buffer_memory": "peak_buffer_bytes",
+    "total_bytes_read": "bytes_read",
+    "total_bytes_written": "bytes_written",
+}
+
+# Result methods that consume the result, after which DuckDB has finished profiling the query
+fetch_methods = {"fetchone", "fetchmany", "fetchall", "fetchdf", "fetch_df", "df", "fetchnumpy",
+                 "to_arrow_table", "fetch_arrow_table", "arrow", "pl"}
+
+
+# Functions that run queries for their caller (the analysis result cache) are marked with @query_helper;
+# queries run inside one are attributed to the function that called it, otherwise to the function calling execute()
+attribution = threading.local()
+
+
+def query_helper(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if getattr(attribution, "caller", None) is not None:
+            return function(*args, **kwargs)
+        attribution.caller = sys._getframe(1).f_code.co_name
+        try:
+            return function(*args, **kwargs)
+        finally:
+            attribution.caller = None
+    return wrapper
+
+
+def calling_function():
+    return getattr(attribution, "caller", None) or sys._getframe(2).f_code.co_name
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Collects the metrics of one stage and writes them, thread-safe, to the stage's metrics file
+class StageMetrics:
+    def __init__(self, stage, path=None, slow_ms=None):
+        self.stage = stage
+        self.path = path or f"{stage}_metrics.jsonl"
+        self.slow_ms = slow_ms
+        self.run_id = datetime.datetime.now().isoformat(timespec="seconds")
+        self.lock = threading.Lock()
+        self.queries = []
+        self.start = time.perf_counter()
+        self.file = open(self.path, "a")
+
+    # duckdb.connect() with profiling on
+    def connect(self, *args, **kwargs):
+        return ProfiledConnection(duckdb.connect(*args, **kwargs), self)
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps({"stage": self.stage, "run_id": self.run_id, **entry}, default=str) + "\n")
+            self.file.flush()
+
+    def record(self, entry):
+        with self.lock:
+            self.queries.append(entry)
+        self.write({"type": "query", **entry})
+        if entry.get("plan"):
+            logger.info(f"Slow query in {entry['caller']} ({entry['wall_s']:.2f}s):\n{entry['plan']}")
+
+    # Writes the stage summary: total wall time, time spent in queries, peak RSS and the slowest queries by caller
+    def close(self):
+        wall_s = time.perf_counter() - self.start
+        by_caller = {}
+        for entry in self.queries:
+            stats = by_caller.setdefault(entry["caller"], {"queries": 0, "wall_s": 0.0})
+            stats["queries"] += 1
+            stats["wall_s"] = round(stats["wall_s"] + entry["wall_s"], 4)
+        slowest = sorted(by_caller.items(), key=lambda item: item[1]["wall_s"], reverse=True)
+        summary = {
+            "type": "stage",
+            "wall_s": round(wall_s, 4),
+            "queries": len(self.queries),
+            "query_s": round(sum(entry["wall_s"] for entry in self.queries), 4),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "by_caller": dict(slowest),
+        }
+        self.write(summary)
+        self.file.close()
+        logger.info(f"{self.stage}: {summary['queries']} queries, {summary['query_s']:.2f}s in queries, "
+                    f"{summary['wall_s']:.2f}s total, peak RSS {summary['peak_rss_mb']} MB, metrics in {self.path}")
+        return summary
+
+
+# Wraps a DuckDB connection or cursor; anything other than execute/cursor/close goes to the connection as is
+# A query is recorded when its result is fetched, or when the next statement runs (DDL/DML are never fetched)
+class ProfiledConnection:
+    def __init__(self, con, metrics):
+        self._con = con
+        self._metrics = metrics
+        self._pending = None
+        con.execute("PRAGMA enable_profiling = 'no_output'")
+
+    def execute(self, query, parameters=None):
+        self.finish()
+        caller = calling_function()
+        start = time.perf_counter()
+        try:
+            result = self._con.execute(query, parameters) if parameters is not None else self._con.execute(query)
+        except Exception as e:
+            self._metrics.record({"caller": caller, "query": " ".join(query.split()),
+                                  "wall_s": round(time.perf_counter() - start, 4), "error": str(e)})
+            raise
+        self._pending = (caller, query, start)
+        return ProfiledResult(result, self)
+
+    # Records the pending query with DuckDB's profile of it
+    def finish(self):
+        if self._pending is None:
+            return
+        caller, query, start = self._pending
+        self._pending = None
+        wall_s = time.perf_counter() - start
+        entry = {"caller": caller, "query": " ".join(query.split()), "wall_s": round(wall_s, 4)}
+        try:
+            profile = json.loads(self._con.get_profiling_information(format="json"))
+            entry.update({name: profile[field] for field, name in profile_fields.items() if field in profile})
+            if self._metrics.slow_ms is not None and wall_s * 1000 >= self._metrics.slow_ms:
+                entry["plan"] = self._con.get_profiling_information(format="query_tree")
+        except Exception as e:
+            logger.warning(f"No profile for query in {caller}: {e}")
+        self._metrics.record(entry)
+
+    # Cursors get their own profiling (it is per cursor in DuckDB) but share the stage's metrics file
+    def cursor(self):
+        return ProfiledConnection(self._con.cursor(), self._metrics)
+
+    def close(self):
+        self.finish()
+        self._con.close()
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+# Result of a profiled execute(); fetching it completes the query's metrics
+class ProfiledResult:
+    def __init__(self, result, con):
+        self._result = result
+        self._con = con
+
+    def __getattr__(self, name):
+        attr = getattr(self._result, name)
+        if name not in fetch_methods:
+            return attr
+
+        def fetch(*args, **kwargs):
+            value = attr(*args, **kwargs)
+            self._con.finish()
+            return value
+        return fetch
@@ -0,0 +1,152 @@
+import datetime
+
+# SQL for the CO2 questions, shared by analysis.py and serve.py
+# Only query text is built here (no pandas or matplotlib), so the query service can import it without the plotting stack
+# Every builder takes a transformed table name and reads either the co2_rollup cube or the trips themselves;
+# use_lake() points the trip queries at the Parquet lake written by export.py instead of the DuckDB tables
+# Dates are datetime.date values written into the SQL as typed DATE/TIMESTAMP literals
+
+rollup_table = "co2_rollup"
+cab_types = {"transformed_green": "green", "transformed_yellow": "yellow"}
+pickup_cols = {"transformed_green": "lpep_pickup_datetime", "transformed_yellow": "tpep_pickup_datetime"}
+
+# Columns answered by the heavy/light questions (Q2-Q5), keyed by the name used in the answers
+question_columns = {
+    "hours": "hour_of_day",
+    "days": "day_of_week",
+    "weeks": "week_of_year",
+    "months": "month_of_year",
+}
+
+# Trip queries read from the DuckDB tables, or from the lake when use_lake() has filled this in
+trip_sources = {}
+
+
+# Points the trip queries at the hive-partitioned lake (one directory per cab type)
+def use_lake(lake):
+    for table, cab in cab_types.items():
+        trip_sources[table] = f"{lake}/cab_type={cab}/*/*/*.parquet"
+
+
+# row_numbers adds the file name and row number columns of each lake row (used for sample blocks)
+def relation(table, row_numbers=False):
+    if table not in trip_sources:
+        return table
+    extra = ", filename = true, file_row_number = true" if row_numbers else ""
+    return f"read_parquet('{trip_sources[table]}', hive_partitioning = true{extra})"
+
+
+# Pickup date filters - start inclusive, end exclusive (None = open ended)
+# The transformed tables are stored ordered by pickup time (dbt models), so DuckDB's min/max zone maps skip the row
+# groups outside the range instead of scanning the whole decade
+# The rollup holds whole pickup months, so it can only answer ranges whose ends fall on the first of a month
+def month_aligned(start=None, end=None):
+    return all(date is None or date.day == 1 for date in (start, end))
+
+
+def date_conditions(table, start=None, end=None, use_rollup=False):
+    column, cast = ("pickup_month", "DATE") if use_rollup else (pickup_cols[table], "TIMESTAMP")
+    conditions = []
+    if start is not None:
+        conditions.append(f"{column} >= {cast} '{start.isoformat()}'")
+    if end is not None:
+        conditions.append(f"{column} < {cast} '{end.isoformat()}'")
+    if not use_rollup and table in trip_sources:
+        conditions += partition_conditions(start, end)
+    return conditions
+
+
+# The lake is partitioned by pickup month (year=/month= directories), so the same range on the hive columns
+# lets DuckDB skip the files of other months without opening them
+def partition_conditions(start=None, end=None):
+    conditions = []
+    if start is not None:
+        conditions.append(f"year * 100 + month >= {start.year * 100 + start.month}")
+    if end is not None:
+        last = end - datetime.timedelta(days=1)
+        conditions.append(f"year * 100 + month <= {last.year * 100 + last.month}")
+    return conditions
+
+
+def where_clause(*conditions):
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+
+# WHERE clause of a question: the cab type and date range from the rollup, the date range from the trips
+def question_filter(table, use_rollup=True, start=None, end=None):
+    if use_rollup:
+        return where_clause(f"cab_type = '{cab_types[table]}'", *date_conditions(table, start, end, use_rollup))
+    return where_clause(*date_conditions(table, start, end))
+
+
+# Describes the range for output, e.g. 2023-07-01 to 2023-10-01
+def date_range_label(start=None, end=None):
+    return f"{start or 'first trip'} to {end or 'last trip'}"
+
+
+# Q1 - largest co2 trip, one row
+def largest_trip_query(table, use_rollup=True, start=None, end=None):
+    if use_rollup:
+        return f"""
+            SELECT arg_max(co2_max_trip_distance, co2_max) AS trip_distance, MAX(co2_max) AS trip_co2_kgs
+            FROM {rollup_table}
+            {question_filter(table, use_rollup, start, end)}
+            ;
+        """
+    return f"""
+        SELECT trip_distance, trip_co2_kgs
+        FROM {relation(table)}
+        {question_filter(table, use_rollup, start, end)}
+        ORDER BY trip_co2_kgs DESC
+        LIMIT 1
+        ;
+    """
+
+
+# Q2-Q5 - average co2 per value of `column`, heaviest first (ties broken by the value)
+# From the rollup the average is rebuilt as total co2 / number of trips with a co2 value
+def average_co2_query(table, column, use_rollup=True, start=None, end=None):
+    if use_rollup:
+        return f"""
+            SELECT {column}, SUM(co2_sum) / SUM(co2_count) AS avg_co2
+            FROM {rollup_table}
+            {question_filter(table, use_rollup, start, end)}
+            GROUP BY {column}
+            ORDER BY avg_co2 DESC, {column}
+            ;
+        """
+    return f"""
+        SELECT {column}, AVG(trip_co2_kgs) AS avg_co2
+        FROM {relation(table)}
+        {question_filter(table, use_rollup, start, end)}
+        GROUP BY {column}
+        ORDER BY avg_co2 DESC, {column}
+        ;
+    """
+
+
+# Q6 data - co2 totals per pickup month, x axis label built in SQL as year_month
+def monthly_totals_query(table, use_rollup=True, start=None, end=None):
+    if use_rollup:
+        return f"""
+            SELECT year, month_of_year, printf('%d-%d', year, month_of_year) AS year_month, SUM(co2_sum) AS total_co2
+            FROM {rollup_table}
+            {question_filter(table, use_rollup, start, end)}
+            GROUP BY year, month_of_year
+            ORDER BY year, month_of_year;
+        """
+    # year computed in a subquery so it never clashes with the lake's hive `year` column
+    return f"""
+        SELECT
+        year,
+        month_of_year,
+        printf('%d-%d', year, month_of_year) AS year_month,
+        SUM(trip_co2_kgs) AS total_co2
+        FROM (
+            SELECT EXTRACT(YEAR FROM {pickup_cols[table]}) AS year, month_of_year, trip_co2_kgs
+            FROM {relation(table)}
+            {question_filter(table, use_rollup, start, end)}
+        )
+        GROUP BY year, month_of_year
+        ORDER BY year, month_of_year;
+    """
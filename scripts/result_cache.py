@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import pyarrow as pa
+import tempfile
+import threading
+import time
+from profiling import query_helper
+
+# Persistent cache of analysis query results
+# An entry is keyed by the query text plus the version of the table it reads, so a rebuilt table never serves
+# stale results; entries for old versions simply stop being used and age out under the size cap
+# Results are stored as zstd-compressed Arrow IPC files, index.json holds sizes, last access and plot digests
+# No logging.basicConfig here - messages go to the log file of the script that imports it (analysis.log)
+
+logger = logging.getLogger(__name__)
+
+default_result_dir = os.path.join(".cache", "analysis")
+
+
+def digest(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir=default_result_dir, max_bytes=256 * 1024**2):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0, "plots_skipped": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        index.setdefault("results", {})
+        index.setdefault("plots", {})
+        return index
+
+    # index.json is replaced atomically so a crash never leaves it half written
+    def _write_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def result_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.arrow")
+
+    # Cached result of query against the given table version, or None
+    def get(self, query, version):
+        key = digest(" ".join(query.split()), version)
+        with self.lock:
+            entry = self.index["results"].get(key)
+            if entry is None or not os.path.exists(self.result_path(key)):
+                self.index["results"].pop(key, None)
+                self.stats["misses"] += 1
+                return None
+            entry["last_access"] = time.time()
+            self.stats["hits"] += 1
+        with pa.memory_map(self.result_path(key)) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def put(self, query, version, result):
+        key = digest(" ".join(query.split()), version)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            with pa.ipc.new_file(f, result.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+                writer.write_table(result)
+        os.replace(tmp_path, self.result_path(key))
+        with self.lock:
+            self.index["results"][key] = {"size": os.path.getsize(self.result_path(key)), "last_access": time.time()}
+            self._evict()
+            self._write_index()
+
+    # Query through the cache: execute only on a miss
+    @query_helper
+    def fetch(self, con, query, version):
+        result = self.get(query, version)
+        if result is None:
+            result = con.execute(query).to_arrow_table()
+            self.put(query, version, result)
+        return result
+
+    # Least recently used results are dropped until the cache fits under max_bytes
+    def _evict(self):
+        results = self.index["results"]
+        total = sum(entry["size"] for entry in results.values())
+        for key, entry in sorted(results.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            del results[key]
+            if os.path.exists(self.result_path(key)):
+                os.remove(self.result_path(key))
+            total -= entry["size"]
+            self.stats["evicted"] += 1
+            logger.info(f"Evicted result {key} ({entry['size']} bytes)")
+
+    # A plot is current if its file exists and was drawn from data with this digest
+    def plot_is_current(self, path, data_digest):
+        with self.lock:
+            current = os.path.exists(path) and self.index["plots"].get(path) == data_digest
+            if current:
+                self.stats["plots_skipped"] += 1
+            return current
+
+    def record_plot(self, path, data_digest):
+        with self.lock:
+            self.index["plots"][path] = data_digest
+            self._write_index()
+
+    # Writes last access times and reports hits and misses
+    def log_stats(self):
+        with self.lock:
+            self._write_index()
+        stats = self.stats
+        message = (
+            f"Result cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evicted']} evicted, "
+            f"{stats['plots_skipped']} plots unchanged"
+        )
+        print(message)
+        logger.info(message)
@@ -0,0 +1,180 @@
+import argparse
+import logging
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import time
+
+# Scores any trip export (Parquet or CSV) with trip_co2_kgs and avg_mph, for every vehicle type in vehicle_emissions.csv
+# Same formulas as the dbt models: trip_co2_kgs = trip_distance * co2_grams_per_mile / 1000,
+# avg_mph = trip_distance / (duration in hours), NULL for zero-length trips
+# Files are streamed as Arrow record batches of at most batch_size rows and written out batch by batch,
+# so memory stays constant however many rows the input has
+# The co2 factor of each row is looked up by its vehicle_type column (or one --vehicle-type for the whole file)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+    filename="score.log"
+)
+logger = logging.getLogger(__name__)
+
+default_emissions = os.path.join("data", "vehicle_emissions.csv")
+default_batch_size = 128 * 1024
+
+
+# Lookup of co2 grams per mile by vehicle type, as two aligned Arrow arrays
+def load_factors(path=default_emissions):
+    emissions = pv.read_csv(path)
+    return (
+        pc.cast(emissions["vehicle_type"], pa.string()).combine_chunks(),
+        pc.cast(emissions["co2_grams_per_mile"], pa.float64()).combine_chunks(),
+    )
+
+
+# Factor per row: a hash lookup of each vehicle type in the (small) emissions table
+# Dictionary-encoded columns (common in Parquet) only look up their distinct values
+def lookup_factors(vehicle_types, factors):
+    types, grams = factors
+    if pa.types.is_dictionary(vehicle_types.type):
+        return pc.take(lookup_factors(vehicle_types.dictionary, factors), vehicle_types.indices)
+    return pc.take(grams, pc.index_in(pc.cast(vehicle_types, pa.string()), value_set=types))
+
+
+# First column ending in suffix (tpep_/lpep_ pickup and dropoff in TLC files, plain names elsewhere)
+def find_column(names, suffix):
+    return next((name for name in names if name.endswith(suffix)), None)
+
+
+# Trip duration in seconds: trip_duration_s if the file has it, otherwise dropoff - pickup
+def duration_seconds(batch):
+    names = batch.schema.names
+    if "trip_duration_s" in names:
+        return pc.cast(batch.column("trip_duration_s"), pa.float64())
+    pickup = find_column(names, "pickup_datetime")
+    dropoff = find_column(names, "dropoff_datetime")
+    if pickup is None or dropoff is None:
+        return None
+    start, end = (
+        batch.column(name) if pa.types.is_timestamp(batch.schema.field(name).type)
+        else pc.cast(batch.column(name), pa.timestamp("us"))
+        for name in (pickup, dropoff)
+    )
+    return pc.cast(pc.seconds_between(start, end), pa.float64())
+
+
+# co2 factor of a single vehicle type
+def factor_for(vehicle_type, factors):
+    types, grams = factors
+    index = pc.index_in(pa.array([vehicle_type]), value_set=types)[0]
+    if not index.is_valid:
+        raise ValueError(f"Unknown vehicle type {vehicle_type}")
+    return grams[index.as_py()]
+
+
+# Fails on the first batch, naming the flag to use, when a column the scoring needs isn't in the file
+def check_columns(schema, vehicle_col=None):
+    if "trip_distance" not in schema.names:
+        raise ValueError("No trip_distance column in the input")
+    if vehicle_col is not None and vehicle_col not in schema.names:
+        raise ValueError(f"No vehicle type column {vehicle_col} in the input, "
+                         f"pass --vehicle-col <column> or --vehicle-type <type>")
+
+
+# Adds trip_co2_kgs and avg_mph to one record batch (vectorised Arrow kernels, no Python loop over rows)
+# grams_per_mile is one factor for every row, or None to look each row's vehicle type up in factors
+# Returns the scored batch and the number of rows whose vehicle type has no co2 factor
+def score_batch(batch, factors, grams_per_mile=None, vehicle_col="vehicle_type"):
+    distance = pc.cast(batch.column("trip_distance"), pa.float64())
+    unknown = 0
+    if grams_per_mile is None:
+        vehicle_types = batch.column(vehicle_col)
+        grams_per_mile = lookup_factors(vehicle_types, factors)
+        unknown = grams_per_mile.null_count - vehicle_types.null_count
+
+    co2 = pc.divide(pc.multiply(distance, grams_per_mile), 1000.0)
+    duration = duration_seconds(batch)
+    if duration is None:
+        mph = pa.nulls(len(batch), pa.float64())
+    else:
+        hours = pc.divide(duration, 3600.0)
+        hours = pc.if_else(pc.equal(hours, 0.0), pa.scalar(None, pa.float64()), hours)
+        mph = pc.divide(distance, hours)
+
+    scored = batch.append_column("trip_co2_kgs", co2).append_column("avg_mph", mph)
+    return scored, unknown
+
+
+# Writes batches to Parquet (zstd) or CSV depending on the output extension; opened on the first batch
+class BatchWriter:
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, batch):
+        if self.writer is None:
+            if self.path.endswith(".csv"):
+                self.writer = pv.CSVWriter(self.path, batch.schema)
+            else:
+                self.writer = pq.ParquetWriter(self.path, batch.schema, compression="zstd")
+        self.writer.write_batch(batch)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+# Record batches of at most batch_size rows from Parquet or CSV files (a file, a directory or a list of them)
+# Read-ahead is kept to one batch and one file so memory doesn't grow with the input
+def read_batches(source, batch_size=default_batch_size):
+    paths = source if isinstance(source, list) else [source]
+    first = paths[0]
+    file_format = "csv" if first.endswith(".csv") or (os.path.isdir(first) and any(
+        name.endswith(".csv") for name in os.listdir(first))) else "parquet"
+    dataset = ds.dataset(paths if len(paths) > 1 else first, format=file_format)
+    return dataset.to_batches(batch_size=batch_size, batch_readahead=1, fragment_readahead=1)
+
+
+# Main function - scores source into output, one batch at a time
+def score_file(source, output, vehicle_type=None, vehicle_col="vehicle_type", batch_size=default_batch_size,
+               emissions=default_emissions):
+    factors = load_factors(emissions)
+    grams_per_mile = factor_for(vehicle_type, factors) if vehicle_type is not None else None
+    writer = BatchWriter(output)
+    stats = {"rows": 0, "batches": 0, "unknown_vehicle_rows": 0}
+    start = time.perf_counter()
+    try:
+        for batch in read_batches(source, batch_size):
+            if not stats["batches"]:
+                check_columns(batch.schema, vehicle_col if grams_per_mile is None else None)
+            scored, unknown = score_batch(batch, factors, grams_per_mile, vehicle_col)
+            writer.write(scored)
+            stats["rows"] += len(batch)
+            stats["batches"] += 1
+            stats["unknown_vehicle_rows"] += unknown
+    finally:
+        writer.close()
+    stats["seconds"] = time.perf_counter() - start
+
+    rate = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+    print(f"Scored {stats['rows']} rows in {stats['batches']} batches ({stats['seconds']:.1f}s, {rate:,.0f} rows/s) -> {output}")
+    logger.info(f"Scored {source} -> {output}: {stats}")
+    if stats["unknown_vehicle_rows"]:
+        print(f"{stats['unknown_vehicle_rows']} rows have a vehicle type without a co2 factor (trip_co2_kgs is NULL)")
+        logger.warning(f"{stats['unknown_vehicle_rows']} rows with unknown vehicle type in {source}")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add trip_co2_kgs and avg_mph to a Parquet or CSV trip file")
+    parser.add_argument("source", nargs="+", help="Parquet/CSV file(s) or a directory of them")
+    parser.add_argument("--output", required=True, help="output file (.parquet or .csv)")
+    parser.add_argument("--vehicle-type", help="score every row as this vehicle type (e.g. uber_x) instead of reading a column")
+    parser.add_argument("--vehicle-col", default="vehicle_type", help="column holding each row's vehicle type")
+    parser.add_argument("--batch-size", type=int, default=default_batch_size, help="rows per record batch")
+    parser.add_argument("--emissions", default=default_emissions, help="co2 factors per vehicle type")
+    args = parser.parse_args()
+
+    score_file(args.source, args.output, args.vehicle_type, args.vehicle_col, args.batch_size, args.emissions)
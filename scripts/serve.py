@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import datetime
+import duckdb
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from queries import (rollup_table, cab_types, question_columns, month_aligned, largest_trip_query,
+                     average_co2_query, monthly_totals_query)
+
+# Long-lived query service over emissions.duckdb - the analysis questions as HTTP/JSON endpoints on localhost
+# One read-only connection is opened at start and a pool of its cursors is kept warm; each request takes a free
+# cursor and runs on a worker thread, so concurrent requests run side by side instead of queuing on one connection
+# Every endpoint takes cab=yellow|green (default both) and a pickup date range start=YYYY-MM-DD / end=YYYY-MM-DD
+# (end exclusive). Ranges of whole months are answered from co2_rollup, other ranges from the transformed trip tables
+# GET /stats reports request count and p50/p90/p99 latency per endpoint
+# emissions.duckdb stays open (read-only) while the service runs, so stop it before load/clean/dbt write to the database
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+    filename="serve.log"
+)
+logger = logging.getLogger(__name__)
+
+trip_tables = {cab: table for table, cab in cab_types.items()}
+
+# Heavy/light endpoints and the column each one averages over
+endpoint_columns = {f"/{name}": column for name, column in question_columns.items()}
+
+# Latency samples kept per endpoint for the percentiles
+latency_window = 10000
+
+
+class BadRequest(Exception):
+    pass
+
+
+# Cab types and date range of a request, checked before they get near a query
+def parse_filters(params):
+    cab = params.get("cab", ["all"])[0]
+    if cab != "all" and cab not in trip_tables:
+        raise BadRequest(f"cab must be yellow, green or all, not {cab}")
+    cabs = list(trip_tables) if cab == "all" else [cab]
+    dates = {}
+    for name in ["start", "end"]:
+        if name in params:
+            try:
+                dates[name] = datetime.date.fromisoformat(params[name][0])
+            except ValueError:
+                raise BadRequest(f"{name} must be a date (YYYY-MM-DD), not {params[name][0]}")
+    if "start" in dates and "end" in dates and dates["start"] >= dates["end"]:
+        raise BadRequest("start must be before end")
+    return cabs, dates.get("start"), dates.get("end")
+
+
+# The rollup holds whole pickup months, so it can answer a range only when both ends fall on the first of a month
+def use_rollup(has_rollup, start, end):
+    return has_rollup and month_aligned(start, end)
+
+
+# SQL for one endpoint and cab type, built by queries.py like the analysis script's
+def build_query(path, cab, start, end, rollup):
+    table = trip_tables[cab]
+    if path == "/largest":
+        return largest_trip_query(table, rollup, start, end)
+    if path == "/monthly":
+        return monthly_totals_query(table, rollup, start, end)
+    return average_co2_query(table, endpoint_columns[path], rollup, start, end)
+
+
+endpoints = ["/largest", *endpoint_columns, "/monthly"]
+
+
+# Fixed pool of cursors on one read-only connection; a request waits for a free cursor, never for another query
+class CursorPool:
+    def __init__(self, database, size):
+        self.con = duckdb.connect(database=database, read_only=True)
+        self.cursors = [self.con.cursor() for _ in range(size)]
+        self.free = asyncio.Queue()
+        for cursor in self.cursors:
+            self.free.put_nowait(cursor)
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="query")
+        self.has_rollup = self.con.execute(
+            f"SELECT COUNT(*) FROM information_schema.tables WHERE table_name = '{rollup_table}'"
+        ).fetchone()[0] > 0
+
+    # Runs the query on a free cursor in a worker thread; rows come back as a list of dicts
+    async def run(self, query):
+        cursor = await self.free.get()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, lambda: cursor.execute(query).to_arrow_table().to_pylist()
+            )
+        finally:
+            self.free.put_nowait(cursor)
+
+    # Answers every endpoint once on every cursor, so the first real requests find the tables in DuckDB's buffer
+    # manager and the cursors past their first-query setup
+    async def warm(self):
+        start = time.perf_counter()
+        queries = []
+        for path in endpoints:
+            for cab in trip_tables:
+                queries.append(build_query(path, cab, None, None, self.has_rollup))
+        for _ in self.cursors:
+            await asyncio.gather(*(self.run(query) for query in queries))
+        logger.info(f"Warmed {len(self.cursors)} cursors in {time.perf_counter() - start:.2f}s")
+
+    def close(self):
+        self.executor.shutdown()
+        for cursor in self.cursors:
+            cursor.close()
+        self.con.close()
+
+
+# Rolling latency samples per endpoint
+class LatencyStats:
+    def __init__(self, window=latency_window):
+        self.window = window
+        self.samples = {}
+        self.counts = {}
+
+    def record(self, path, ms):
+        self.samples.setdefault(path, deque(maxlen=self.window)).append(ms)
+        self.counts[path] = self.counts.get(path, 0) + 1
+
+    # Nearest-rank percentiles over the samples in the window
+    def summary(self):
+        summary = {}
+        for path, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            def percentile(p):
+                return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 3)
+            summary[path] = {"requests": self.counts[path], "p50_ms": percentile(50), "p90_ms": percentile(90),
+                             "p99_ms": percentile(99), "max_ms": round(ordered[-1], 3)}
+        return summary
+
+
+class QueryService:
+    def __init__(self, pool):
+        self.pool = pool
+        self.stats = LatencyStats()
+
+    # Handles one GET request; returns (status, body)
+    async def handle(self, target):
+        url = urlsplit(target)
+        if url.path == "/stats":
+            return 200, {"endpoints": self.stats.summary()}
+        if url.path == "/":
+            return 200, {"endpoints": [*endpoints, "/stats"], "parameters": ["cab", "start", "end"]}
+        if url.path not in endpoints:
+            return 404, {"error": f"unknown endpoint {url.path}"}
+
+        start_time = time.perf_counter()
+        try:
+            cabs, start, end = parse_filters(parse_qs(url.query))
+        except BadRequest as e:
+            return 400, {"error": str(e)}
+        rollup = use_rollup(self.pool.has_rollup, start, end)
+
+        async def answer(cab):
+            return cab, await self.pool.run(build_query(url.path, cab, start, end, rollup))
+        try:
+            results = dict(await asyncio.gather(*(answer(cab) for cab in cabs)))
+        except duckdb.Error as e:
+            logger.error(f"{target} failed: {e}")
+            return 500, {"error": str(e)}
+
+        ms = (time.perf_counter() - start_time) * 1000
+        self.stats.record(url.path, ms)
+        return 200, {
+            "endpoint": url.path,
+            "filters": {"cab": cabs, "start": start, "end": end},
+            "source": rollup_table if rollup else "trips",
+            "ms": round(ms, 3),
+            "results": results,
+        }
+
+    # Minimal HTTP/1.1: GET only, JSON bodies, keep-alive unless the client asks to close
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    status, body = 400, {"error": "malformed request line"}
+                elif parts[0] != "GET":
+                    status, body = 405, {"error": f"{parts[0]} not allowed, use GET"}
+                else:
+                    status, body = await self.handle(parts[1])
+                keep_alive = headers.get("connection", "").lower() != "close" and not parts[-1:] == ["HTTP/1.0"]
+                payload = json.dumps(body, default=str).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(database="emissions.duckdb", host="127.0.0.1", port=8022, cursors=4, warm=True):
+    pool = CursorPool(database, cursors)
+    service = QueryService(pool)
+    if warm:
+        await pool.warm()
+    server = await asyncio.start_server(service.serve_connection, host, port)
+    print(f"Serving {database} on http://{host}:{port} with {cursors} cursors")
+    logger.info(f"Serving {database} on {host}:{port} with {cursors} cursors (rollup: {pool.has_rollup})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        logger.info(f"Stopped, latency per endpoint: {service.stats.summary()}")
+        pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the CO2 questions as HTTP/JSON endpoints over emissions.duckdb")
+    parser.add_argument("--database", default="emissions.duckdb")
+    parser.add_argument("--host", default="127.0.0.1", help="interface to listen on (localhost only by default)")
+    parser.add_argument("--port", type=int, default=8022)
+    parser.add_argument("--cursors", type=int, default=4, help="read-only cursors, i.e. queries run concurrently")
+    parser.add_argument("--no-warm", action="store_true", help="skip answering every endpoint once at start")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.database, args.host, args.port, args.cursors, warm=not args.no_warm))
+    except KeyboardInterrupt:
+        pass
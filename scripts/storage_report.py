@@ -0,0 +1,130 @@
+import argparse
+import duckdb
+import json
+import logging
+import os
+
+# Storage footprint of the trip tables in emissions.duckdb: rows, estimated on-disk bytes and bytes per row
+# Save a snapshot before switching to compact types (load.py --compact, dbt --vars '{compact: true}')
+# and compare against it afterwards
+# DuckDB reuses the blocks of dropped tables but never shrinks its file, so after a switch like that
+# --rewrite copies the database into a fresh file (only the live data) and swaps it in
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+    filename="storage_report.log"
+)
+logger = logging.getLogger(__name__)
+
+report_tables = [
+    "yellow", "green",
+    "yellow_clean", "green_clean",
+    "transformed_yellow", "transformed_green",
+    "co2_rollup",
+]
+
+
+# Estimated on-disk bytes per table from pragma_storage_info
+# Segments are laid out back to back inside shared blocks, so a segment's size is the gap to the next
+# segment in the same block (or to the end of the block for the last one)
+def table_sizes(con, tables):
+    block_size = con.execute("SELECT block_size FROM pragma_database_size()").fetchone()[0]
+    segments = " UNION ALL ".join(
+        f"SELECT '{table}' AS table_name, block_id, block_offset FROM pragma_storage_info('{table}') WHERE block_id >= 0"
+        for table in tables
+    )
+    return dict(con.execute(f"""
+        SELECT table_name, SUM(size) AS bytes
+        FROM (
+            SELECT table_name,
+                   COALESCE(LEAD(block_offset) OVER (PARTITION BY block_id ORDER BY block_offset), {block_size})
+                       - block_offset AS size
+            FROM ({segments})
+        )
+        GROUP BY table_name
+    """).fetchall())
+
+
+# Builds the report for every trip table that exists
+def storage_report(database="emissions.duckdb"):
+    con = duckdb.connect(database=database, read_only=True)
+    existing = {row[0] for row in con.execute("SELECT table_name FROM information_schema.tables").fetchall()}
+    tables = [table for table in report_tables if table in existing]
+    sizes = table_sizes(con, tables) if tables else {}
+
+    report = {"database_bytes": os.path.getsize(database), "tables": {}}
+    for table in tables:
+        rows = con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        types = dict(con.execute("""
+            SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ?
+        """, [table]).fetchall())
+        size = int(sizes.get(table, 0))
+        report["tables"][table] = {
+            "rows": rows,
+            "bytes": size,
+            "bytes_per_row": size / rows if rows else 0.0,
+            "columns": types,
+        }
+    con.close()
+    return report
+
+
+# Copies every table of the database into a new file and replaces the old one with it
+# Needs the database to itself (no other process may have it open). Returns (bytes before, bytes after)
+def rewrite_database(database="emissions.duckdb"):
+    tmp_path = f"{database}.rewrite"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    before = os.path.getsize(database)
+    con = duckdb.connect(database=database)
+    try:
+        con.execute("CHECKPOINT")
+        con.execute(f"ATTACH '{tmp_path}' AS rewritten")
+        name = con.execute("SELECT current_database()").fetchone()[0]
+        con.execute(f"COPY FROM DATABASE {name} TO rewritten")
+        con.execute("DETACH rewritten")
+    finally:
+        con.close()
+    os.replace(tmp_path, database)
+    after = os.path.getsize(database)
+    logger.info(f"Rewrote {database}: {before} -> {after} bytes")
+    print(f"Rewrote {database}: {before / 1024**2:.1f} MB -> {after / 1024**2:.1f} MB")
+    return before, after
+
+
+# Prints the report, side by side with an earlier snapshot when given
+def print_report(report, before=None):
+    lines = [f"{'table':<20}{'rows':>14}{'MB':>10}{'B/row':>8}" + (f"{'MB before':>11}{'B/row before':>14}{'change':>9}" if before else "")]
+    for table, stats in report["tables"].items():
+        line = f"{table:<20}{stats['rows']:>14}{stats['bytes'] / 1024**2:>10.1f}{stats['bytes_per_row']:>8.1f}"
+        previous = (before or {}).get("tables", {}).get(table)
+        if previous:
+            change = (stats["bytes"] - previous["bytes"]) / previous["bytes"] * 100 if previous["bytes"] else 0.0
+            line += f"{previous['bytes'] / 1024**2:>11.1f}{previous['bytes_per_row']:>14.1f}{change:>8.1f}%"
+        lines.append(line)
+    lines.append(f"emissions.duckdb file: {report['database_bytes'] / 1024**2:.1f} MB"
+                 + (f" (before: {before['database_bytes'] / 1024**2:.1f} MB)" if before else ""))
+    for line in lines:
+        print(line)
+        logger.info(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the storage footprint of the trip tables")
+    parser.add_argument("--save", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="JSON report from an earlier run to compare against")
+    parser.add_argument("--rewrite", action="store_true",
+                        help="first copy emissions.duckdb into a fresh file to give back the space of dropped tables")
+    args = parser.parse_args()
+
+    if args.rewrite:
+        rewrite_database()
+    report = storage_report()
+    before = None
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+    print_report(report, before)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)